@@ -0,0 +1,72 @@
+"""Compare ORM hydration with the Core tuple projection used by the listing.
+
+    $ python benchmarks/bench_listing.py --rows 100000
+
+Builds a throwaway SQLite database, then reads every movie both ways and
+reports wall time and peak Python memory (tracemalloc) per row.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def measure(label, fn, rows):
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    result = fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+
+    print('%-8s %8.1f ms  %6.2f us/row  %8.1f KiB peak  %6.0f B/row' % (
+        label, best * 1000, best * 1e6 / rows, peak / 1024, peak / rows))
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['DATABASE_FILE'] = path
+
+    from watchlist import app, db
+    from watchlist.models import Movie
+
+    with app.app_context():
+        db.create_all()
+        db.session.execute(Movie.__table__.insert(), [
+            {'title': 'Movie %d' % i, 'year': str(1900 + i % 120)} for i in range(args.rows)])
+        db.session.commit()
+
+        def orm():
+            rows = Movie.query.order_by(Movie.id).all()
+            db.session.expunge_all()
+            return rows
+
+        def core():
+            return db.session.execute(Movie.select_rows().order_by(Movie.id)).fetchall()
+
+        print('%d rows' % args.rows)
+        orm_time, orm_peak = measure('orm', orm, args.rows)
+        core_time, core_peak = measure('core', core, args.rows)
+        print('core is %.1fx faster and uses %.1fx less memory' % (
+            orm_time / core_time, orm_peak / core_peak))
+
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
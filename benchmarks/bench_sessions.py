@@ -0,0 +1,77 @@
+"""Compare the signed cookie session with the server-side session stores.
+
+    $ python benchmarks/bench_sessions.py --cycles 2000
+
+For each SESSION_BACKEND (cookie, memory, sqlite) a fresh process builds a
+throwaway SQLite database, logs in, then repeats a flash + redirect + read
+cycle (an invalid add followed by the listing that shows the message) and
+reports time per cycle and the size of the session cookie sent back.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BACKENDS = ('cookie', 'memory', 'sqlite')
+
+
+def run(cycles):
+    from watchlist import app, db
+    from watchlist.models import User
+
+    with app.app_context():
+        db.create_all()
+        user = User(name='Bench', username='bench')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.commit()
+
+    client = app.test_client()
+    client.post('/login', data=dict(username='bench', password='bench'))
+
+    def cycle():
+        response = client.post('/', data=dict(title='', year=''))
+        cookie = response.headers.get('Set-Cookie', '')
+        client.get('/')
+        return cookie
+
+    for _ in range(50):
+        cycle()
+
+    set_cookie = 0
+    start = time.perf_counter()
+    for _ in range(cycles):
+        set_cookie += len(cycle())
+    elapsed = time.perf_counter() - start
+
+    cookie = [c for c in client.cookie_jar if c.name == app.session_cookie_name]
+    size = len(cookie[0].value) if cookie else 0
+    print('%-8s %8.1f us/cycle  %4d B cookie  %6.1f B Set-Cookie/cycle' % (
+        app.config['SESSION_BACKEND'], elapsed * 1e6 / cycles, size, set_cookie / cycles))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cycles', type=int, default=2000)
+    parser.add_argument('--backend', choices=BACKENDS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.backend:
+        run(args.cycles)
+        return
+
+    # 会话方式在导入 watchlist 时确定，每种方式用单独的进程
+    for backend in BACKENDS:
+        path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        env = dict(os.environ, DATABASE_FILE=path, SESSION_BACKEND=backend, RATELIMIT_ENABLED='0')
+        subprocess.run([sys.executable, os.path.abspath(__file__),
+                        '--cycles', str(args.cycles), '--backend', backend], env=env, check=True)
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
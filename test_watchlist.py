@@ -1,8 +1,31 @@
+import gzip
+import itertools
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from unittest import mock
 
-from watchlist import app, db
-from watchlist.models import User, Movie
+from jinja2 import Environment, ModuleLoader
+from sqlalchemy import event
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import check_password_hash
+
+from watchlist import app, db, login_manager, page_cache, owner_cache, user_cache, write_queue, hash_pool, login_limiter, write_limiter, \
+    load_compiled_templates, TEMPLATES_DIGEST_FILE
+from watchlist.models import User, Movie, Revision, insert_movie
+from watchlist.pagination import encode_cursor
 from watchlist.commands import forge, initdb
+from watchlist.pragmas import pragma_statements
+from watchlist.ratelimit import TokenBucketLimiter
+from watchlist.sessions import ServerSideSessionInterface, MemorySessionStore, SqliteSessionStore
+from watchlist.security import HashPool, HashPoolBusy
+from watchlist.writequeue import WriteQueue
 
 
 class WatchlistTestCase(unittest.TestCase):
@@ -17,9 +40,16 @@ class WatchlistTestCase(unittest.TestCase):
         db.create_all()
         user = User(name='Test', username='test')
         user.set_password('123')
-        movie = Movie(title='Test Movie Title', year='2020')
-        db.session.add_all([user, movie])
+        db.session.add(user)
+        db.session.flush()
+        movie = Movie(title='Test Movie Title', year='2020', user_id=user.id)
+        db.session.add(movie)
         db.session.commit()
+        page_cache.invalidate()
+        owner_cache.invalidate()
+        user_cache.clear()
+        login_limiter.clear()
+        write_limiter.clear()
 
         self.client = app.test_client()
         self.runner = app.test_cli_runner()
@@ -49,6 +79,315 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertIn('Test Movie Title', data)
         self.assertEqual(response.status_code, 200)
 
+    # 测试游标分页
+    def test_index_pagination(self):
+        db.session.add_all([Movie(title='Movie %02d' % i, year='2000', user_id=1) for i in range(5)])
+        db.session.commit()
+
+        response = self.client.get('/?per_page=4')
+        data = response.get_data(as_text=True)
+        self.assertIn('Test Movie Title', data)
+        self.assertIn('Movie 02', data)
+        self.assertNotIn('Movie 03', data)
+        self.assertIn('Next', data)
+        self.assertNotIn('Prev', data)
+
+        next_url = [part for part in data.split('"') if 'after=' in part][0].replace('&amp;', '&')
+        response = self.client.get(next_url)
+        data = response.get_data(as_text=True)
+        self.assertIn('Movie 03', data)
+        self.assertIn('Movie 04', data)
+        self.assertNotIn('Movie 02', data)
+        self.assertIn('Prev', data)
+        self.assertNotIn('Next', data)
+
+        prev_url = [part for part in data.split('"') if 'before=' in part][0].replace('&amp;', '&')
+        response = self.client.get(prev_url)
+        data = response.get_data(as_text=True)
+        self.assertIn('Test Movie Title', data)
+        self.assertIn('Movie 02', data)
+        self.assertNotIn('Movie 03', data)
+
+        response = self.client.get('/?sort=title&per_page=2')
+        data = response.get_data(as_text=True)
+        self.assertIn('Movie 00', data)
+        self.assertIn('Movie 01', data)
+        self.assertNotIn('Test Movie Title', data)
+
+        next_url = [part for part in data.split('"') if 'after=' in part][0].replace('&amp;', '&')
+        data = self.client.get(next_url).get_data(as_text=True)
+        self.assertIn('Movie 02', data)
+        self.assertIn('Movie 03', data)
+        self.assertNotIn('Movie 01', data)
+
+        response = self.client.get('/?after=not-a-cursor')
+        self.assertEqual(response.status_code, 400)
+
+        # 值的类型或范围不对的游标也返回 400
+        for sort, values in (('id', [{}]), ('id', [10 ** 30]), ('id', [True]), ('id', ['1']),
+                             ('title', [1, 1]), ('year', ['x', 1]), ('year', [2000, None]), ('year', [2000])):
+            response = self.client.get('/', query_string=dict(sort=sort, after=encode_cursor(values)))
+            self.assertEqual(response.status_code, 400, (sort, values))
+        self.assertEqual(self.client.get('/?after=W3t9XQ').status_code, 400)
+
+    # 测试按年份排序翻页时跨过年份为空的条目
+    def test_index_pagination_null_year(self):
+        db.session.add_all([Movie(title='No Year %d' % i, year=None, user_id=1) for i in range(3)])
+        db.session.add_all([Movie(title='Movie %d' % year, year=year, user_id=1) for year in range(1990, 1993)])
+        db.session.commit()
+
+        titles = []
+        url = '/?sort=year&per_page=2'
+        for _ in range(10):
+            data = self.client.get(url).get_data(as_text=True)
+            titles += re.findall(r'^\s*(.+?) - \d*\s*$', data, re.M)
+            next_urls = [part for part in data.split('"') if 'after=' in part]
+            if not next_urls:
+                break
+            url = next_urls[0].replace('&amp;', '&')
+        self.assertEqual(titles, ['No Year 0', 'No Year 1', 'No Year 2',
+                                  'Movie 1990', 'Movie 1991', 'Movie 1992', 'Test Movie Title'])
+
+        # 从最后一页往回翻
+        pages = []
+        for _ in range(3):
+            data = self.client.get(url).get_data(as_text=True)
+            url = [part for part in data.split('"') if 'before=' in part][0].replace('&amp;', '&')
+            pages.append(re.findall(r'^\s*(.+?) - \d*\s*$', self.client.get(url).get_data(as_text=True), re.M))
+        self.assertEqual(pages, [['Movie 1991', 'Movie 1992'], ['No Year 2', 'Movie 1990'], ['No Year 0', 'No Year 1']])
+
+    # 测试年份范围过滤
+    def test_index_year_filter(self):
+        db.session.add_all([Movie(title='Movie %d' % year, year=year, user_id=1) for year in range(1990, 2000)])
+        db.session.commit()
+
+        data = self.client.get('/?year_from=1993&year_to=1995').get_data(as_text=True)
+        self.assertIn('Movie 1993', data)
+        self.assertIn('Movie 1995', data)
+        self.assertNotIn('Movie 1992', data)
+        self.assertNotIn('Movie 1996', data)
+        self.assertNotIn('Test Movie Title', data)
+
+        data = self.client.get('/?year_from=1990&sort=year&per_page=3').get_data(as_text=True)
+        self.assertIn('Movie 1992', data)
+        self.assertNotIn('Movie 1993', data)
+        next_url = [part for part in data.split('"') if 'after=' in part][0].replace('&amp;', '&')
+        self.assertIn('year_from=1990', next_url)
+        data = self.client.get(next_url).get_data(as_text=True)
+        self.assertIn('Movie 1993', data)
+        self.assertIn('Movie 1995', data)
+        self.assertNotIn('Movie 1996', data)
+
+        self.assertEqual(self.client.get('/?year_from=99999999999999999999').status_code, 400)
+        self.assertEqual(self.client.get('/?year_to=-1').status_code, 400)
+
+    # 测试首页缓存
+    def test_index_page_cache(self):
+        self.client.get('/')
+        db.session.add(Movie(title='Uncached Movie', year='2021', user_id=1))
+        db.session.commit()
+
+        # 直接写数据库不会使缓存失效
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Test Movie Title', data)
+        self.assertNotIn('Uncached Movie', data)
+
+        # 登录后是另一份缓存
+        self.login()
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Uncached Movie', data)
+        self.assertIn('Logout', data)
+
+        self.client.post('/', data=dict(title='New Movie', year='2020'))
+        self.client.get('/logout')
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Uncached Movie', data)
+        self.assertIn('New Movie', data)
+        self.assertNotIn('Logout', data)
+
+    # 测试条件请求
+    def test_index_conditional_get(self):
+        response = self.client.get('/')
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Cookie', response.headers['Vary'])
+
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+
+        # 不存在的用户即使带着有效的 ETag 也是 404
+        response = self.client.get('/u/nobody', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 404)
+
+        page_cache.invalidate()
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+        self.login()
+        self.client.post('/', data=dict(title='New Movie', year='2020'))
+        self.client.get('/logout')
+        self.client.get('/')  # 取走提示消息
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn('New Movie', response.get_data(as_text=True))
+
+    # 测试每个用户的列表
+    def test_user_lists(self):
+        alice = User(name='Alice', username='alice')
+        alice.set_password('456')
+        db.session.add(alice)
+        db.session.flush()
+        db.session.add_all([
+            Movie(title='Alice Movie', year=2001, user_id=alice.id),
+            Movie(title='Test Movie Title', year=2020, user_id=alice.id),
+        ])
+        db.session.commit()
+        alice_movie = Movie.query.filter_by(title='Alice Movie').first().id
+
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Test\'s Watchlist', data)
+        self.assertNotIn('Alice Movie', data)
+
+        data = self.client.get('/u/alice').get_data(as_text=True)
+        self.assertIn('Alice\'s Watchlist', data)
+        self.assertIn('Alice Movie', data)
+        self.assertIn('2 Titles on this page', data)
+        self.assertEqual(self.client.get('/u/nobody').status_code, 404)
+        self.assertIn('Alice Movie', self.client.get('/u/alice/all').get_data(as_text=True))
+        self.assertIn('Alice Movie', self.client.get('/u/alice/search?q=alice').get_data(as_text=True))
+        self.assertIn('No results', self.client.get('/search?q=alice').get_data(as_text=True))
+        data = self.client.get('/u/alice/export.csv', headers={'Accept-Encoding': 'identity'}).get_data(as_text=True)
+        self.assertEqual(data.splitlines(), ['title,year', 'Alice Movie,2001', 'Test Movie Title,2020'])
+
+        # 只能修改自己的电影，别人的列表上没有编辑按钮
+        self.login()
+        data = self.client.get('/u/alice').get_data(as_text=True)
+        self.assertNotIn('Edit', data)
+        self.assertEqual(self.client.get('/movie/edit/%d' % alice_movie).status_code, 404)
+        self.assertEqual(self.client.post('/movie/delete/%d' % alice_movie).status_code, 404)
+        self.client.post('/movie/batch', data=dict(action='delete', ids=[alice_movie]))
+        self.assertIsNotNone(Movie.query.get(alice_movie))
+        response = self.client.post('/', data=dict(title='Alice Movie', year='2001'), follow_redirects=True)
+        self.assertIn('Item created.', response.get_data(as_text=True))
+        self.assertEqual(Movie.query.filter_by(title='Alice Movie').count(), 2)
+
+        self.client.get('/logout')
+        self.client.post('/login', data=dict(username='alice', password='456'))
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Alice\'s Watchlist', data)
+        self.assertIn('Alice Movie', data)
+        self.assertIn('Edit', data)
+
+    # 测试匿名访问的快速路径：不经过 Flask-Login 加载用户，命中页面缓存时不执行任何 SQL
+    def test_anonymous_fast_path(self):
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        self.client.get('/')
+        event.listen(db.engine, 'before_cursor_execute', count)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute', count)
+        with mock.patch.object(login_manager, '_load_user', wraps=login_manager._load_user) as load_user:
+            data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Test Movie Title', data)
+        self.assertIn('Login', data)
+        self.assertEqual(statements, [])
+        self.assertFalse(load_user.called)
+
+        # 有会话 cookie 时照常加载用户
+        self.login()
+        del statements[:]
+        user_cache.clear()
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Logout', data)
+        self.assertTrue(any('FROM user' in statement for statement in statements))
+
+    # 测试流式输出全部电影
+    def test_show_all_page(self):
+        db.session.add_all([Movie(title='Movie %02d' % i, year='2000', user_id=1) for i in range(30)])
+        db.session.commit()
+
+        response = self.client.get('/all')
+        self.assertTrue(response.is_streamed)
+        data = response.get_data(as_text=True)
+        self.assertIn('Test\'s Watchlist', data)
+        self.assertIn('Test Movie Title', data)
+        self.assertIn('Movie 29', data)
+        self.assertNotIn('Edit', data)
+
+        self.login()
+        self.client.post('/', data=dict(title='New Movie', year='2020'))
+        data = self.client.get('/all').get_data(as_text=True)
+        self.assertIn('Item created.', data)
+        self.assertIn('Edit', data)
+        data = self.client.get('/all').get_data(as_text=True)
+        self.assertNotIn('Item created.', data)
+
+    # 测试导出
+    def test_export(self):
+        db.session.add(Movie(title='Comma, Movie', year=1999, user_id=1))
+        db.session.commit()
+
+        response = self.client.get('/export.csv', headers={'Accept-Encoding': 'identity'})
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.mimetype, 'text/csv')
+        data = response.get_data(as_text=True)
+        self.assertEqual(data.splitlines(), ['title,year', 'Test Movie Title,2020', '"Comma, Movie",1999'])
+
+        response = self.client.get('/export.ndjson', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        lines = gzip.decompress(response.get_data()).decode('utf-8').splitlines()
+        self.assertEqual(json.loads(lines[1]), {'title': 'Comma, Movie', 'year': 1999})
+
+        self.assertEqual(self.client.get('/export.xml').status_code, 404)
+
+    # 测试全文搜索
+    def test_search(self):
+        db.session.add_all([
+            Movie(title='My Neighbor Totoro', year='1988', user_id=1),
+            Movie(title='Totoro Returns', year='2020', user_id=1),
+            Movie(title='WALL-E', year='2008', user_id=1),
+        ])
+        db.session.commit()
+
+        data = self.client.get('/search?q=totoro').get_data(as_text=True)
+        self.assertIn('My Neighbor Totoro', data)
+        self.assertIn('Totoro Returns', data)
+        self.assertNotIn('WALL-E', data)
+
+        data = self.client.get('/search?q=neigh').get_data(as_text=True)
+        self.assertIn('My Neighbor Totoro', data)
+        self.assertNotIn('Totoro Returns', data)
+
+        data = self.client.get('/search?q=totoro&per_page=1').get_data(as_text=True)
+        self.assertIn('Next', data)
+        data = self.client.get('/search?q=totoro&per_page=1&page=2').get_data(as_text=True)
+        self.assertIn('Prev', data)
+        self.assertNotIn('Next', data)
+
+        # 编辑、删除后索引同步更新
+        self.login()
+        movie_id = Movie.query.filter_by(title='WALL-E').first().id
+        self.client.post('/movie/edit/%d' % movie_id, data=dict(title='Totoro Again', year='2008'))
+        data = self.client.get('/search?q=totoro').get_data(as_text=True)
+        self.assertIn('Totoro Again', data)
+        self.client.post('/movie/delete/%d' % movie_id)
+        data = self.client.get('/search?q=again').get_data(as_text=True)
+        self.assertIn('No results', data)
+
+        data = self.client.get('/search?q=NEAR(" *').get_data(as_text=True)
+        self.assertIn('No results', data)
+
+        self.assertEqual(self.client.get('/search?q=m&page=100000000000000000000').status_code, 400)
+        self.assertEqual(self.client.get('/search?q=m&page=%d' % (app.config['SEARCH_MAX_PAGE'] + 1)).status_code, 400)
+        data = self.client.get('/search?q=totoro&per_page=1&page=%d' % app.config['SEARCH_MAX_PAGE']).get_data(as_text=True)
+        self.assertNotIn('Next', data)
+
     # 辅助方法， 用于用户登录
     def login(self):
         self.client.post('/login', data=dict(
@@ -86,6 +425,33 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertNotIn('Item created.', data)
         self.assertIn('Invalid input.', data)
 
+    def test_create_duplicate_item(self):
+        self.login()
+
+        response = self.client.post('/', data=dict(
+            title = ' test movie title ',
+            year = '2020'
+        ), follow_redirects=True)
+        data = response.get_data(as_text=True)
+        self.assertNotIn('Item created.', data)
+        self.assertIn('Item already exists.', data)
+        self.assertEqual(Movie.query.count(), 1)
+
+        response = self.client.post('/', data=dict(
+            title = 'Test Movie Title',
+            year = '2021'
+        ), follow_redirects=True)
+        self.assertIn('Item created.', response.get_data(as_text=True))
+
+        # 编辑成已存在的电影
+        response = self.client.post('/movie/edit/2', data=dict(
+            title = 'TEST MOVIE TITLE',
+            year = '2020'
+        ), follow_redirects=True)
+        data = response.get_data(as_text=True)
+        self.assertIn('Item already exists.', data)
+        self.assertEqual(Movie.query.get(2).year, 2021)
+
     def test_update_item(self):
         self.login()
 
@@ -112,15 +478,84 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertIn('Item updated.', data)
         self.assertIn(' ', data)
 
-        # year = ' ' maybe bug
+        # 年份必须是数字
         response = self.client.post('/movie/edit/1', data=dict(
             title = 'New Movie Edited Again',
             year = ' '
         ), follow_redirects=True)
         data = response.get_data(as_text=True)
-        self.assertIn('Item updated.', data)
-        self.assertIn('New Movie Edited Again', data)
-        self.assertIn(' ', data)
+        self.assertNotIn('Item updated.', data)
+        self.assertIn('Invalid input.', data)
+
+        response = self.client.post('/movie/edit/1', data=dict(
+            title = 'New Movie Edited Again',
+            year = '20x0'
+        ), follow_redirects=True)
+        data = response.get_data(as_text=True)
+        self.assertNotIn('Item updated.', data)
+        self.assertIn('Invalid input.', data)
+
+        response = self.client.post('/movie/edit/1', data=dict(
+            title = 'New Movie Edited Again',
+            year = '\u0663'
+        ), follow_redirects=True)
+        self.assertIn('Invalid input.', response.get_data(as_text=True))
+
+    # 测试 upgrade 留下的无年份电影：不显示 None，保存时可以不填年份
+    def test_update_item_without_year(self):
+        db.session.add(Movie(title='Odd', year=None, user_id=1))
+        db.session.commit()
+        movie_id = Movie.query.filter_by(title='Odd').first().id
+        self.login()
+
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Odd - \n', data)
+        self.assertNotIn('None', data)
+        data = self.client.get('/movie/edit/%d' % movie_id).get_data(as_text=True)
+        self.assertIn('name="year" autocomplete="off" value=""', data)
+
+        response = self.client.post('/movie/edit/%d' % movie_id, data=dict(title='Odd Renamed', year=''),
+                                    follow_redirects=True)
+        self.assertIn('Item updated.', response.get_data(as_text=True))
+        self.assertIsNone(Movie.query.get(movie_id).year)
+
+    def test_bulk_create_items(self):
+        response = self.client.post('/movie/bulk', json=[{'title': 'Bulk Movie', 'year': 2001}])
+        self.assertEqual(response.status_code, 302)
+
+        self.login()
+        response = self.client.post('/movie/bulk', json=[
+            {'title': 'Bulk Movie 1', 'year': 2001},
+            {'title': 'Bulk Movie 2', 'year': '2002'},
+            {'title': '', 'year': 2003},
+            {'title': 'Bulk Movie 4', 'year': 'x'},
+            'not an object',
+        ])
+        data = response.get_json()
+        self.assertEqual(data['created'], 2)
+        self.assertEqual(data['invalid'], 3)
+        self.assertEqual([r['status'] for r in data['results']],
+                         ['created', 'created', 'invalid', 'invalid', 'invalid'])
+        self.assertEqual(Movie.query.filter_by(title='Bulk Movie 2').first().year, 2002)
+
+        body = '{"title": "Line Movie", "year": 1999}\n\nnot json\n{"title": "Line Movie 2", "year": 2000}\n'
+        response = self.client.post('/movie/bulk', data=body, content_type='application/x-ndjson')
+        data = response.get_json()
+        self.assertEqual(data['created'], 2)
+        self.assertEqual(data['results'][1]['status'], 'invalid')
+
+        data = self.client.get('/?per_page=100').get_data(as_text=True)
+        self.assertIn('Line Movie 2', data)
+
+        response = self.client.post('/movie/bulk', json=[
+            {'title': 'bulk movie 1', 'year': 2001},
+            {'title': 'Fresh Movie', 'year': 2005},
+            {'title': 'Fresh Movie ', 'year': 2005},
+        ])
+        data = response.get_json()
+        self.assertEqual(data['created'], 1)
+        self.assertEqual(data['duplicate'], 2)
+        self.assertEqual([r['status'] for r in data['results']], ['duplicate', 'created', 'duplicate'])
 
     def test_delete_item(self):
         self.login()
@@ -130,6 +565,49 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertIn('Item deleted.', data)
         self.assertNotIn('Test Movie Title', data)
 
+    def test_batch_items(self):
+        db.session.add_all([Movie(title='Movie %d' % i, year=2000, user_id=1) for i in range(5)])
+        db.session.commit()
+        ids = [movie.id for movie in Movie.query.filter(Movie.title.like('Movie %')).all()]
+
+        self.login()
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('name="ids" value="%d"' % ids[0], data)
+
+        response = self.client.post('/movie/batch', data=dict(
+            action='set_year', year='1999', ids=ids[:3]
+        ), follow_redirects=True)
+        self.assertIn('3 items updated.', response.get_data(as_text=True))
+        self.assertEqual(Movie.query.filter_by(year=1999).count(), 3)
+
+        response = self.client.post('/movie/batch', data=dict(
+            action='set_year', year='19x9', ids=ids[:3]
+        ), follow_redirects=True)
+        self.assertIn('Invalid input.', response.get_data(as_text=True))
+
+        response = self.client.post('/movie/batch', data=dict(
+            action='delete', ids=ids[1:] + [999]
+        ), follow_redirects=True)
+        data = response.get_data(as_text=True)
+        self.assertIn('4 items deleted.', data)
+        self.assertIn('Movie 0', data)
+        self.assertNotIn('Movie 4', data)
+
+        response = self.client.post('/movie/batch', data=dict(action='delete'), follow_redirects=True)
+        self.assertIn('0 items deleted.', response.get_data(as_text=True))
+        self.assertEqual(self.client.post('/movie/batch', data=dict(action='drop')).status_code, 400)
+
+    def test_write_missing_item(self):
+        self.login()
+        version = Revision.current()[0]
+
+        response = self.client.post('/movie/edit/99', data=dict(title='Nothing', year='2020'))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.post('/movie/delete/99')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(Revision.current()[0], version)
+        self.assertEqual(Movie.query.count(), 1)
+
     # 测试登录保护
     def test_login_protect(self):
         response = self.client.get('/')
@@ -192,6 +670,186 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertNotIn('Login success.', data)
         self.assertIn('Invalid username or password.', data)
 
+    # 测试修改哈希设置后登录时自动升级旧哈希
+    def test_login_rehash(self):
+        user = User.query.first()
+        self.assertFalse(user.needs_rehash())
+        old_hash = user.password_hash
+        app.config.update(PASSWORD_HASH_METHOD='pbkdf2:sha256:1000', PASSWORD_SALT_LENGTH=12)
+        try:
+            self.assertTrue(user.needs_rehash())
+            response = self.client.post('/login', data=dict(
+                username='test',
+                password='123'
+            ), follow_redirects=True)
+            self.assertIn('Login success.', response.get_data(as_text=True))
+            db.session.expire_all()
+            user = User.query.first()
+            self.assertNotEqual(user.password_hash, old_hash)
+            self.assertTrue(user.password_hash.startswith('pbkdf2:sha256:1000$'))
+            self.assertFalse(user.needs_rehash())
+            self.assertTrue(user.validate_password('123'))
+        finally:
+            app.config.update(PASSWORD_HASH_METHOD='pbkdf2:sha256:150000', PASSWORD_SALT_LENGTH=8)
+
+    # 测试不存在的用户名同样要校验一次哈希
+    def test_login_unknown_username(self):
+        with mock.patch('watchlist.views.check_password_hash', wraps=check_password_hash) as check:
+            response = self.client.post('/login', data=dict(username='nobody', password='123'),
+                                        follow_redirects=True)
+        self.assertIn('Invalid username or password.', response.get_data(as_text=True))
+        self.assertEqual(check.call_count, 1)
+        self.assertNotEqual(check.call_args[0][0], User.query.first().password_hash)
+
+    # 测试哈希计算超时
+    def test_login_hash_timeout(self):
+        with mock.patch.object(hash_pool, 'run', side_effect=FutureTimeoutError()):
+            response = self.client.post('/login', data=dict(username='test', password='123'))
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Too many login attempts', response.get_data(as_text=True))
+
+    def test_hash_pool_busy(self):
+        pool = HashPool(workers=1, backlog=0)
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+            return True
+
+        worker = threading.Thread(target=pool.run, args=(block,))
+        worker.start()
+        started.wait(5)
+        with self.assertRaises(HashPoolBusy):
+            pool.run(lambda: True)
+        release.set()
+        worker.join(5)
+        self.assertTrue(pool.run(lambda: True))
+
+    # 测试登录限流
+    def test_login_rate_limit(self):
+        for i in range(app.config['RATELIMIT_LOGIN_BURST']):
+            response = self.client.post('/login', data=dict(username='test', password='456'))
+            self.assertEqual(response.status_code, 302)
+        response = self.client.post('/login', data=dict(username='test', password='123'))
+        data = response.get_data(as_text=True)
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Too Many Requests - 429', data)
+        self.assertIn('Retry-After', response.headers)
+
+        # 同一用户名换一个 IP 也会被限制
+        response = self.client.post('/login', data=dict(username='test', password='123'),
+                                    environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        self.assertEqual(response.status_code, 429)
+
+        # 查看登录页不受影响
+        response = self.client.get('/login')
+        self.assertEqual(response.status_code, 200)
+
+    # 测试超长用户名不占用限流桶
+    def test_login_rate_limit_long_username(self):
+        self.client.post('/login', data=dict(username='x' * 10000, password='456'))
+        self.assertEqual(len(login_limiter), 1)
+        self.client.post('/login', data=dict(username='x' * 20, password='456'))
+        self.assertEqual(len(login_limiter), 2)
+
+    # 测试批量写入接口同样限流
+    def test_bulk_rate_limit(self):
+        self.login()
+        for i in range(app.config['RATELIMIT_WRITE_BURST']):
+            self.client.post('/movie/bulk', json=[])
+        response = self.client.post('/movie/bulk', json=[{'title': 'Bulk Movie', 'year': 2001}])
+        self.assertEqual(response.status_code, 429)
+        response = self.client.post('/movie/batch', data=dict(action='delete', ids=['1']))
+        self.assertEqual(response.status_code, 429)
+        self.assertIsNotNone(Movie.query.get(1))
+
+    # 测试反向代理之后按 X-Forwarded-For 中的客户端地址限流
+    def test_rate_limit_behind_proxy(self):
+        default = app.wsgi_app
+        app.wsgi_app = ProxyFix(default, x_for=1)
+        try:
+            for i in range(app.config['RATELIMIT_WRITE_BURST']):
+                self.client.post('/', headers={'X-Forwarded-For': '10.0.0.1'})
+            response = self.client.post('/', headers={'X-Forwarded-For': '10.0.0.1'})
+            self.assertEqual(response.status_code, 429)
+            response = self.client.post('/', headers={'X-Forwarded-For': '10.0.0.2'})
+            self.assertEqual(response.status_code, 302)
+        finally:
+            app.wsgi_app = default
+
+    def test_token_bucket(self):
+        limiter = TokenBucketLimiter(rate=1, burst=2, maxsize=3)
+        self.assertIsNone(limiter.hit('a', now=0))
+        self.assertIsNone(limiter.hit('a', now=0))
+        self.assertAlmostEqual(limiter.hit('a', now=0), 1)
+        self.assertIsNone(limiter.hit('a', now=1.5))
+
+        # 空闲到装满的桶和超出上限的桶会被清掉
+        for key in 'bcde':
+            limiter.hit(key, now=2)
+        self.assertEqual(len(limiter), 3)
+        limiter.hit('f', now=10)
+        self.assertEqual(len(limiter), 1)
+
+    # 测试服务端会话：cookie 中只有会话 id
+    def check_server_side_session(self, store):
+        default = app.session_interface
+        app.session_interface = ServerSideSessionInterface(store)
+        try:
+            response = self.client.get('/')
+            self.assertNotIn('Set-Cookie', response.headers)
+
+            # 登录前已有的会话 id 在登录后作废
+            response = self.client.post('/login', data=dict(username='', password=''))
+            anonymous_sid = self.session_id(response)
+            self.assertIsNotNone(store.get(anonymous_sid))
+            self.client.get('/login')
+
+            response = self.client.post('/login', data=dict(username='test', password='123'))
+            sid = self.session_id(response)
+            self.assertNotIn('.', sid)
+            self.assertNotEqual(sid, anonymous_sid)
+            self.assertIsNone(store.get(anonymous_sid))
+            self.assertIsNotNone(store.get(sid))
+
+            # 会话内容改变时不必重新发送 cookie
+            response = self.client.get('/')
+            data = response.get_data(as_text=True)
+            self.assertIn('Login success.', data)
+            self.assertIn('Logout', data)
+            self.assertNotIn('Set-Cookie', response.headers)
+
+            # 剩余有效期不到一半时访问会延长有效期
+            data, expires = store.get(sid)
+            store.save(sid, data, time.time() + 60)
+            self.client.get('/')
+            self.assertGreater(store.get(sid)[1], time.time() + 86400 / 2)
+
+            response = self.client.get('/logout')
+            self.assertNotEqual(self.session_id(response), sid)
+            self.assertIsNone(store.get(sid))
+            response = self.client.get('/')
+            self.assertIn('Goodbye.', response.get_data(as_text=True))
+
+            # 未知的会话 id 当作新会话
+            self.client.set_cookie('localhost', app.session_cookie_name, 'unknown')
+            response = self.client.get('/')
+            self.assertNotIn('Logout', response.get_data(as_text=True))
+        finally:
+            app.session_interface = default
+
+    def session_id(self, response):
+        cookie = response.headers['Set-Cookie']
+        return cookie.split(';')[0].split('=', 1)[1]
+
+    def test_memory_session(self):
+        self.check_server_side_session(MemorySessionStore(maxsize=10))
+
+    def test_sqlite_session(self):
+        self.check_server_side_session(SqliteSessionStore(lambda: db.get_engine(app)))
+
     # 测试登出
     def test_logout(self):
         self.login()
@@ -230,16 +888,220 @@ class WatchlistTestCase(unittest.TestCase):
         # self.assertIn('Invalid input.', data)
 
 
+    # 测试站长资料缓存
+    def test_owner_cache(self):
+        response = self.client.get('/nothing')
+        self.assertIn('Test\'s Watchlist', response.get_data(as_text=True))
+
+        User.query.first().name = 'Changed'
+        db.session.commit()
+        response = self.client.get('/nothing')
+        self.assertIn('Test\'s Watchlist', response.get_data(as_text=True))
+
+        self.runner.invoke(args=['admin', '--username', 'test', '--password', '123'])
+        response = self.client.get('/nothing')
+        self.assertIn('Changed\'s Watchlist', response.get_data(as_text=True))
+
+    # 测试已登录用户的缓存
+    def test_user_cache(self):
+        self.login()
+        self.client.get('/setting')
+        self.assertEqual(user_cache.get(1).name, 'Test')
+
+        # 缓存命中时不再查询数据库
+        User.query.get(1).name = 'Changed'
+        db.session.commit()
+        data = self.client.get('/setting').get_data(as_text=True)
+        self.assertIn('value="Test"', data)
+
+        self.client.post('/setting', data=dict(name='Grey Li'))
+        self.assertIsNone(user_cache.get(1))
+        data = self.client.get('/setting').get_data(as_text=True)
+        self.assertIn('value="Grey Li"', data)
+
+        self.runner.invoke(args=['admin', '--username', 'test', '--password', '456'])
+        self.assertIsNone(user_cache.get(1))
+
     # 测试自定义命令行命令
     def test_forge_command(self):
         result = self.runner.invoke(forge)
         self.assertIn('Done', result.output)
         self.assertNotEqual(Movie.query.count(), 0)
 
+        count = Movie.query.count()
+        result = self.runner.invoke(forge)
+        self.assertIn('Done', result.output)
+        self.assertEqual(Movie.query.count(), count)
+
+    def test_forge_command_count(self):
+        result = self.runner.invoke(args=['forge', '--count', '25', '--seed', '7', '--batch-size', '10'])
+        self.assertIn('10/25 movies', result.output)
+        self.assertIn('25/25 movies', result.output)
+        self.assertIn('Done', result.output)
+        self.assertEqual(Movie.query.count(), 26)
+
+        first = [(m.title, m.year) for m in Movie.query.order_by(Movie.id).offset(1)]
+        Movie.query.filter(Movie.id > 1).delete()
+        db.session.commit()
+        self.runner.invoke(args=['forge', '--count', '25', '--seed', '7'])
+        second = [(m.title, m.year) for m in Movie.query.order_by(Movie.id).offset(1)]
+        self.assertEqual(first, second)
+
+        # 再次执行时编号接着已有的电影，新插入 25 条
+        result = self.runner.invoke(args=['forge', '--count', '25', '--seed', '7'])
+        self.assertIn('25/25 movies', result.output)
+        self.assertEqual(Movie.query.count(), 51)
+        self.assertEqual(Movie.query.filter(Movie.title.like('% #26')).count(), 1)
+
+        # 生成的电影全部重复时停止，不会一直循环
+        row = {'title': 'Test Movie Title', 'year': 2020}
+        with mock.patch('watchlist.commands.generate_movies', return_value=itertools.repeat(row)):
+            result = self.runner.invoke(args=['forge', '--count', '5'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('No new movies could be generated after 0 of 5.', result.output)
+
+    def test_adduser_command(self):
+        result = self.runner.invoke(args=['adduser', '--username', 'alice', '--password', '456', '--name', 'Alice'])
+        self.assertIn('Created user alice.', result.output)
+        self.assertEqual(User.query.count(), 2)
+
+        result = self.runner.invoke(args=['adduser', '--username', 'alice', '--password', '789'])
+        self.assertIn('Username alice is already taken.', result.output)
+        self.assertEqual(User.query.count(), 2)
+
+        # 任一账户都能登录，用户名要和密码匹配
+        response = self.client.post('/login', data=dict(username='alice', password='123'), follow_redirects=True)
+        self.assertIn('Invalid username or password.', response.get_data(as_text=True))
+        response = self.client.post('/login', data=dict(username='alice', password='456'), follow_redirects=True)
+        self.assertIn('Login success.', response.get_data(as_text=True))
+        self.client.get('/logout')
+        response = self.client.post('/login', data=dict(username='test', password='123'), follow_redirects=True)
+        self.assertIn('Login success.', response.get_data(as_text=True))
+
     def test_initdb_command(self):
         result = self.runner.invoke(initdb)
         self.assertIn('Initialized database.', result.output)
 
+    def test_upgrade_command(self):
+        db.session.remove()
+        db.drop_all()
+        db.engine.execute('CREATE TABLE movie (id INTEGER NOT NULL, title VARCHAR(60), year VARCHAR(4), PRIMARY KEY (id))')
+        db.engine.execute("INSERT INTO movie (title, year) VALUES ('Leon', '1994'), ('Odd', ' '), ('leon ', '1994')")
+        db.engine.execute('CREATE TABLE user (id INTEGER NOT NULL, name VARCHAR(20), username VARCHAR(20), '
+                          'password_hash VARCHAR(128), PRIMARY KEY (id))')
+        db.engine.execute("INSERT INTO user (name, username) VALUES ('Old', 'old')")
+
+        result = self.runner.invoke(args=['upgrade'])
+        self.assertIn('Converted movie.year', result.output)
+        self.assertIn('Deleted 1 duplicate movies.', result.output)
+        self.assertIn('Created index ix_user_username.', result.output)
+        self.assertIn('Assigned 2 movies to the site owner.', result.output)
+        self.assertEqual(Movie.query.filter_by(title='Leon').first().user_id, 1)
+        self.assertIn('Upgraded database.', result.output)
+        self.assertEqual(Movie.query.filter_by(title='Leon').first().year, 1994)
+        self.assertIsNone(Movie.query.filter_by(title='Odd').first().year)
+        self.assertEqual(Movie.query.filter(Movie.year >= 1990).count(), 1)
+
+        result = self.runner.invoke(args=['upgrade'])
+        self.assertNotIn('Converted movie.year', result.output)
+
+    def test_compile_templates_command(self):
+        compiled_templates = app.config['COMPILED_TEMPLATES']
+        target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target)
+        result = self.runner.invoke(args=['compile-templates', '--target', target])
+        self.assertIn('Compiled', result.output)
+        self.assertTrue(os.listdir(target))
+
+        # 预编译的模板不需要源文件即可加载
+        env = Environment(loader=ModuleLoader(target))
+        html = env.get_template('_search_form.html').render(url_for=lambda endpoint, **values: '/search', q='Totoro')
+        self.assertIn('value="Totoro"', html)
+
+        # 源文件改过而没有重新编译时不使用预编译的模板
+        loader, auto_reload = app.jinja_env.loader, app.jinja_env.auto_reload
+        app.config['COMPILED_TEMPLATES'] = target
+        try:
+            self.assertTrue(load_compiled_templates())
+            app.jinja_env.loader = loader
+            with open(os.path.join(target, TEMPLATES_DIGEST_FILE), 'w') as f:
+                f.write('stale')
+            self.assertFalse(load_compiled_templates())
+            self.assertIs(app.jinja_env.loader, loader)
+        finally:
+            app.jinja_env.loader, app.jinja_env.auto_reload = loader, auto_reload
+            app.config['COMPILED_TEMPLATES'] = compiled_templates
+
+    def test_import_command(self):
+        target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target)
+
+        path = os.path.join(target, 'movies.csv')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('title,year\nImported 1,1990\nImported 2,1991\n,1992\nImported 4,19x3\nImported 5,1994\n')
+        result = self.runner.invoke(args=['import', path, '--chunk-size', '2'])
+        self.assertIn('Imported 3 rows, skipped 2 invalid rows', result.output)
+        self.assertEqual(Movie.query.filter(Movie.title.like('Imported%')).count(), 3)
+
+        path = os.path.join(target, 'movies.ndjson')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('{"title": "Line 1", "year": 2001}\nbroken\n{"title": "Line 2", "year": "2002"}\n')
+        result = self.runner.invoke(args=['import', path])
+        self.assertIn('Imported 2 rows, skipped 1 invalid rows', result.output)
+        self.assertEqual(Movie.query.filter_by(title='Line 2').first().year, 2002)
+
+        result = self.runner.invoke(args=['import', path])
+        self.assertIn('Imported 0 rows, skipped 1 invalid rows and 2 duplicates', result.output)
+
+        # 带 BOM 的 CSV 表头也能识别
+        path = os.path.join(target, 'bom.csv')
+        with open(path, 'w', encoding='utf-8-sig') as f:
+            f.write('title,year\nWith BOM,2003\n')
+        result = self.runner.invoke(args=['import', path])
+        self.assertIn('Imported 1 rows, skipped 0 invalid rows', result.output)
+        self.assertEqual(Movie.query.filter_by(title='With BOM').first().year, 2003)
+
+    def test_dedupe_command(self):
+        db.engine.execute('DROP INDEX uq_movie_user_title_year')
+        db.session.add_all([
+            Movie(title='test movie title', year=2020, user_id=1),
+            Movie(title='Test Movie Title ', year=2020, user_id=1),
+            Movie(title='Test Movie Title', year=2021, user_id=1),
+        ])
+        db.session.commit()
+
+        result = self.runner.invoke(args=['dedupe'])
+        self.assertIn('Deleted 2 duplicate movies.', result.output)
+        self.assertIn('Created index uq_movie_user_title_year.', result.output)
+        self.assertEqual([m.id for m in Movie.query.order_by(Movie.id)], [1, 4])
+
+        result = self.runner.invoke(args=['dedupe'])
+        self.assertIn('Deleted 0 duplicate movies.', result.output)
+
+    def test_export_command(self):
+        target = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, target)
+
+        path = os.path.join(target, 'movies.csv.gz')
+        self.runner.invoke(args=['export', path])
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            self.assertEqual(f.read().splitlines(), ['title,year', 'Test Movie Title,2020'])
+
+        result = self.runner.invoke(args=['export', '-', '--format', 'ndjson'])
+        self.assertEqual(json.loads(result.output), {'title': 'Test Movie Title', 'year': 2020})
+
+    def test_pragmas_command(self):
+        result = self.runner.invoke(args=['pragmas'])
+        self.assertIn('busy_timeout = 5000', result.output)
+        self.assertIn('cache_size = -20000', result.output)
+        self.assertIn('temp_store = 2', result.output)
+
+    def test_pragma_statements(self):
+        statements = pragma_statements({'synchronous': 'normal', 'busy_timeout': '100', 'mmap_size': ''})
+        self.assertEqual(statements, ['PRAGMA busy_timeout = 100', 'PRAGMA synchronous = NORMAL'])
+        with self.assertRaises(ValueError):
+            pragma_statements({'journal_mode': 'wal; DROP TABLE movie'})
+
     def test_admin_command(self):
         db.drop_all()
         db.create_all()
@@ -258,5 +1120,105 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertEqual(User.query.first().username, 'peter')
         self.assertTrue(User.query.first().validate_password('456'))
 
+class WriteQueueTestCase(unittest.TestCase):
+    """ Group commit write queue test"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        app.config.update(
+            TESTING=True,
+            SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(self.directory, 'data.db'),
+            WRITE_QUEUE_ENABLED=True,
+        )
+        db.create_all()
+        user = User(name='Test', username='test')
+        user.set_password('123')
+        db.session.add(user)
+        db.session.flush()
+        movie = Movie(title='Test Movie Title', year=2020, user_id=user.id)
+        db.session.add(movie)
+        db.session.commit()
+        page_cache.invalidate()
+        owner_cache.invalidate()
+        user_cache.clear()
+        login_limiter.clear()
+        write_limiter.clear()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        write_queue.stop()
+        app.config['WRITE_QUEUE_ENABLED'] = False
+        db.session.remove()
+        db.drop_all()
+        db.get_engine(app).dispose()
+        shutil.rmtree(self.directory)
+
+    def test_batches_concurrent_writes(self):
+        commits = []
+        queue = WriteQueue(lambda: db.get_engine(app), max_batch=100, max_delay=0.05,
+                           after_commit=lambda: commits.append(1))
+        self.addCleanup(queue.stop)
+
+        futures = []
+        def submit(i):
+            futures.append(queue.submit(insert_movie, 1, 'Queued %d' % i, 2000))
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(40)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        ids = [future.result(5) for future in futures]
+        self.assertEqual(len(set(ids)), 40)
+        self.assertLess(len(commits), 40)
+        self.assertEqual(Movie.query.filter(Movie.title.like('Queued%')).count(), 40)
+
+    def test_failed_operation_does_not_fail_batch(self):
+        queue = WriteQueue(lambda: db.get_engine(app), max_delay=0.05)
+        self.addCleanup(queue.stop)
+
+        def fail(connection):
+            raise RuntimeError('boom')
+        bad = queue.submit(fail)
+        good = queue.submit(insert_movie, 1, 'Survivor', 2001)
+        with self.assertRaises(RuntimeError):
+            bad.result(5)
+        self.assertTrue(good.result(5))
+        self.assertEqual(Movie.query.filter_by(title='Survivor').count(), 1)
+
+    def test_views_use_queue(self):
+        self.client.post('/login', data=dict(username='test', password='123'))
+        version = Revision.current()[0]
+
+        response = self.client.post('/', data=dict(title='New Movie', year='2020'), follow_redirects=True)
+        data = response.get_data(as_text=True)
+        self.assertIn('Item created.', data)
+        self.assertIn('New Movie', data)
+        self.assertGreater(Revision.current()[0], version)
+
+        response = self.client.post('/movie/edit/1', data=dict(title='Edited', year='2021'), follow_redirects=True)
+        self.assertIn('Edited', response.get_data(as_text=True))
+        response = self.client.post('/movie/delete/1', follow_redirects=True)
+        self.assertNotIn('Edited', response.get_data(as_text=True))
+
+        self.assertEqual(self.client.post('/movie/delete/1').status_code, 404)
+        self.assertEqual(self.client.post('/movie/edit/1', data=dict(title='Edited', year='2021')).status_code, 404)
+
+    # 测试写入队列超时时返回 503，结果未知
+    def test_queue_timeout(self):
+        self.client.post('/login', data=dict(username='test', password='123'))
+        with mock.patch.object(write_queue, 'submit', return_value=Future()):
+            app.config['WRITE_QUEUE_TIMEOUT'] = 0
+            try:
+                response = self.client.post('/', data=dict(title='New Movie', year='2020'))
+            finally:
+                app.config['WRITE_QUEUE_TIMEOUT'] = 10
+        data = response.get_data(as_text=True)
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Service Unavailable - 503', data)
+        self.assertIn('may still be saved', data)
+        self.assertIn('Retry-After', response.headers)
+
 if __name__ == "__main__":
     unittest.main()
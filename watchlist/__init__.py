@@ -1,9 +1,19 @@
+import hashlib
 import os
 import sys
 
-from flask import Flask
+from flask import Flask, request, _request_ctx_stack
+from jinja2 import ChoiceLoader, ModuleLoader
 from flask_sqlalchemy import SQLAlchemy
-from flask_login import LoginManager
+from flask_login import LoginManager, current_user
+from flask_login.config import COOKIE_NAME
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from watchlist.cache import PageCache, ValueCache, LRUCache
+from watchlist.ratelimit import TokenBucketLimiter
+from watchlist.sessions import CookieSessionInterface, ServerSideSessionInterface, MemorySessionStore, SqliteSessionStore
+from watchlist.security import HashPool
+from watchlist.writequeue import WriteQueue
 
 
 WIN = sys.platform.startswith('win')
@@ -21,23 +31,190 @@ app.config['SQLALCHEMY_DATABASE_URI'] = prefix + os.path.join(os.path.dirname(ap
 # app.config['SQLALCHEMY_DATABASE_URI'] = prefix + os.path.join(os.path.dirname(app.root_path), 'data.db')
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# SQLite 调优：每个新连接都会执行这些 PRAGMA，设为空字符串则保持 SQLite 默认值
+# WAL 模式下读不会被写阻塞；synchronous=NORMAL 在 WAL 下只在检查点时 fsync
+app.config['SQLITE_PRAGMAS'] = {
+    'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'busy_timeout': os.getenv('SQLITE_BUSY_TIMEOUT', '5000'), # 毫秒
+    'cache_size': os.getenv('SQLITE_CACHE_SIZE', '-20000'), # 负数表示 KiB
+    'mmap_size': os.getenv('SQLITE_MMAP_SIZE', '268435456'),
+    'temp_store': os.getenv('SQLITE_TEMP_STORE', 'MEMORY'),
+}
+
+# 首页分页：每页条目数及允许通过 ?per_page= 请求的最大值
+app.config['MOVIES_PER_PAGE'] = int(os.getenv('MOVIES_PER_PAGE', 20))
+app.config['MOVIES_MAX_PER_PAGE'] = int(os.getenv('MOVIES_MAX_PER_PAGE', 100))
+# 搜索结果用 OFFSET 翻页，越往后越慢，限制最多能翻到第几页
+app.config['SEARCH_MAX_PAGE'] = int(os.getenv('SEARCH_MAX_PAGE', 100))
+# 首页渲染结果缓存：条目数（0 表示关闭）及最长缓存秒数
+app.config['PAGE_CACHE_SIZE'] = int(os.getenv('PAGE_CACHE_SIZE', 256))
+app.config['PAGE_CACHE_TTL'] = int(os.getenv('PAGE_CACHE_TTL', 30))
+# 模板中显示的站长资料的缓存秒数
+app.config['PROFILE_CACHE_TTL'] = int(os.getenv('PROFILE_CACHE_TTL', 60))
+# 已登录用户的缓存：最多缓存的用户数（0 表示关闭）及缓存秒数
+app.config['USER_CACHE_SIZE'] = int(os.getenv('USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_TTL'] = int(os.getenv('USER_CACHE_TTL', 60))
+# 流式输出全部电影：每批从数据库取出的行数，及每次发送前缓冲的模板片段数
+app.config['STREAM_BATCH_SIZE'] = int(os.getenv('STREAM_BATCH_SIZE', 1000))
+app.config['STREAM_BUFFER_SIZE'] = int(os.getenv('STREAM_BUFFER_SIZE', 100))
+# 批量添加接口一次最多接受的条目数
+app.config['BULK_MAX_ITEMS'] = int(os.getenv('BULK_MAX_ITEMS', 10000))
+# 密码哈希算法和强度，修改后旧的哈希会在用户下次登录时自动升级
+app.config['PASSWORD_HASH_METHOD'] = os.getenv('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:150000')
+app.config['PASSWORD_SALT_LENGTH'] = int(os.getenv('PASSWORD_SALT_LENGTH', 8))
+# 登录时计算哈希的线程数、允许排队的请求数及等待的最长秒数
+app.config['PASSWORD_HASH_WORKERS'] = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_BACKLOG'] = int(os.getenv('PASSWORD_HASH_BACKLOG', 8))
+app.config['PASSWORD_HASH_TIMEOUT'] = int(os.getenv('PASSWORD_HASH_TIMEOUT', 10))
+# 限流：登录和写操作按客户端 IP（登录还按用户名）分别计数
+# 每分钟补充的次数、允许连续请求的次数，及最多记录的客户端数
+app.config['RATELIMIT_ENABLED'] = os.getenv('RATELIMIT_ENABLED', '1').lower() in ('1', 'true', 'yes')
+app.config['RATELIMIT_LOGIN_PER_MINUTE'] = float(os.getenv('RATELIMIT_LOGIN_PER_MINUTE', 10))
+app.config['RATELIMIT_LOGIN_BURST'] = int(os.getenv('RATELIMIT_LOGIN_BURST', 10))
+app.config['RATELIMIT_WRITE_PER_MINUTE'] = float(os.getenv('RATELIMIT_WRITE_PER_MINUTE', 120))
+app.config['RATELIMIT_WRITE_BURST'] = int(os.getenv('RATELIMIT_WRITE_BURST', 60))
+app.config['RATELIMIT_MAX_KEYS'] = int(os.getenv('RATELIMIT_MAX_KEYS', 100000))
+# 部署在反向代理之后时设为代理的层数，客户端 IP 从 X-Forwarded-For 中读取；0 表示直接使用连接地址
+app.config['PROXY_FIX_X_FOR'] = int(os.getenv('PROXY_FIX_X_FOR', 0))
+# 会话存储：cookie（默认，签名后整个放在 cookie 中）、memory 或 sqlite（cookie 只保存会话 id）
+# 非永久会话在服务端保存的秒数，及 memory 方式最多保存的会话数
+app.config['SESSION_BACKEND'] = os.getenv('SESSION_BACKEND', 'cookie')
+app.config['SESSION_TTL'] = int(os.getenv('SESSION_TTL', 86400))
+app.config['SESSION_MEMORY_SIZE'] = int(os.getenv('SESSION_MEMORY_SIZE', 10000))
+# 没有会话和“记住我” cookie 的请求直接当作匿名用户，不经过 Flask-Login 加载用户
+app.config['ANONYMOUS_FAST_PATH'] = os.getenv('ANONYMOUS_FAST_PATH', '1').lower() in ('1', 'true', 'yes')
+# 写队列：开启后新增、编辑、删除由单独的线程按批执行并统一提交
+# 每批最多的操作数、收集一批最多等待的毫秒数，及请求等待结果的最长秒数
+app.config['WRITE_QUEUE_ENABLED'] = os.getenv('WRITE_QUEUE_ENABLED', '').lower() in ('1', 'true', 'yes')
+app.config['WRITE_QUEUE_MAX_BATCH'] = int(os.getenv('WRITE_QUEUE_MAX_BATCH', 64))
+app.config['WRITE_QUEUE_MAX_DELAY_MS'] = int(os.getenv('WRITE_QUEUE_MAX_DELAY_MS', 5))
+app.config['WRITE_QUEUE_TIMEOUT'] = int(os.getenv('WRITE_QUEUE_TIMEOUT', 10))
+# flask compile-templates 生成的预编译模板目录，生产环境下存在时优先从这里加载
+app.config['COMPILED_TEMPLATES'] = os.getenv('COMPILED_TEMPLATES', os.path.join(os.path.dirname(app.root_path), 'compiled_templates'))
 
 
 db = SQLAlchemy(app)
 login_manager = LoginManager(app)
+page_cache = PageCache(maxsize=app.config['PAGE_CACHE_SIZE'], ttl=app.config['PAGE_CACHE_TTL'])
+
+def bump_revision(connection):
+    from watchlist.models import Revision
+    Revision.bump(connection)
+
+write_queue = WriteQueue(lambda: db.get_engine(app),
+    max_batch=app.config['WRITE_QUEUE_MAX_BATCH'],
+    max_delay=app.config['WRITE_QUEUE_MAX_DELAY_MS'] / 1000.0,
+    before_commit=bump_revision,
+    after_commit=page_cache.invalidate)
+
+# compile-templates 把模板源文件的摘要写在编译结果旁边，加载时据此判断是否过期
+TEMPLATES_DIGEST_FILE = 'sources.sha256'
+
+def template_sources_digest():
+    """Hash the names and sources of all templates as the source loaders see them."""
+    loader = app.create_global_jinja_loader()
+    digest = hashlib.sha256()
+    for name in sorted(loader.list_templates()):
+        source = loader.get_source(app.jinja_env, name)[0]
+        digest.update(name.encode('utf-8') + b'\0' + source.encode('utf-8') + b'\0')
+    return digest.hexdigest()
+
+def load_compiled_templates():
+    """Serve templates from precompiled modules, skipping parsing on a cold worker.
+
+    The modules are used only if they were compiled from the current sources,
+    so a deploy that forgot to re-run compile-templates falls back to them.
+    """
+    path = app.config['COMPILED_TEMPLATES']
+    if app.debug or not os.path.isdir(path):
+        return False
+    try:
+        with open(os.path.join(path, TEMPLATES_DIGEST_FILE)) as f:
+            compiled_digest = f.read().strip()
+    except OSError:
+        compiled_digest = None
+    if compiled_digest != template_sources_digest():
+        app.logger.warning('Compiled templates in %s are out of date, run "flask compile-templates".', path)
+        return False
+    app.jinja_env.loader = ChoiceLoader([ModuleLoader(path), app.jinja_env.loader])
+    app.jinja_env.auto_reload = False
+    return True
+
+load_compiled_templates()
+
+hash_pool = HashPool(workers=app.config['PASSWORD_HASH_WORKERS'], backlog=app.config['PASSWORD_HASH_BACKLOG'])
+
+if app.config['SESSION_BACKEND'] == 'memory':
+    app.session_interface = ServerSideSessionInterface(
+        MemorySessionStore(maxsize=app.config['SESSION_MEMORY_SIZE']), ttl=app.config['SESSION_TTL'])
+elif app.config['SESSION_BACKEND'] == 'sqlite':
+    app.session_interface = ServerSideSessionInterface(
+        SqliteSessionStore(lambda: db.get_engine(app)), ttl=app.config['SESSION_TTL'])
+else:
+    app.session_interface = CookieSessionInterface()
+
+login_limiter = TokenBucketLimiter(rate=app.config['RATELIMIT_LOGIN_PER_MINUTE'] / 60,
+                                   burst=app.config['RATELIMIT_LOGIN_BURST'],
+                                   maxsize=app.config['RATELIMIT_MAX_KEYS'])
+write_limiter = TokenBucketLimiter(rate=app.config['RATELIMIT_WRITE_PER_MINUTE'] / 60,
+                                   burst=app.config['RATELIMIT_WRITE_BURST'],
+                                   maxsize=app.config['RATELIMIT_MAX_KEYS'])
+
+if app.config['PROXY_FIX_X_FOR']:
+    # 只信任最后几层代理加上的地址，客户端自己伪造的 X-Forwarded-For 不起作用
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+
+# 按 id 缓存用户快照，已登录的请求不必每次查询 user 表
+user_cache = LRUCache(maxsize=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
 
 @login_manager.user_loader
 def load_user(user_id):
-    from watchlist.models import User
-    user = User.query.get(int(user_id))
-    return user
+    from watchlist.models import User, Profile
+    user_id = int(user_id)
+    profile = user_cache.get(user_id)
+    if profile is None:
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        profile = Profile.from_user(user)
+        user_cache.set(user_id, profile)
+    return profile
 
 login_manager.login_view = 'login'
 
+# 所有匿名请求共用一个匿名用户对象，它没有任何状态
+anonymous_user = login_manager.anonymous_user()
+
+@app.before_request
+def preset_anonymous_user():
+    """Mark requests without a session or remember cookie as anonymous up front.
+
+    Such a request cannot be logged in, so current_user is set directly and
+    Flask-Login never reads the session, hashes the session identifier or
+    queries the user table for it.
+    """
+    if not app.config['ANONYMOUS_FAST_PATH']:
+        return
+    cookies = request.cookies
+    if app.session_cookie_name in cookies or app.config.get('REMEMBER_COOKIE_NAME', COOKIE_NAME) in cookies:
+        return
+    _request_ctx_stack.top.user = anonymous_user
+
+def load_owner():
+    from watchlist.models import User, Profile
+    user = User.query.first()
+    if user is None:
+        return None
+    return Profile.from_user(user)
+
+# 站长资料很少变化，缓存起来，渲染模板时不必每次查询数据库
+owner_cache = ValueCache(load_owner, ttl=app.config['PROFILE_CACHE_TTL'])
+
 @app.context_processor
 def inject_user():
-    from watchlist.models import User
-    user = User.query.first()
+    # 已登录时显示自己的名字，否则显示站长的
+    user = current_user if current_user.is_authenticated else owner_cache.get()
     return dict(user=user)
 
-from watchlist import views, commands, errors
\ No newline at end of file
+from watchlist import pragmas, views, commands, errors
\ No newline at end of file
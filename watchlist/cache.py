@@ -0,0 +1,121 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class PageCache(object):
+    """Rendered pages keyed by a data generation counter.
+
+    Write paths call invalidate() after they commit, which bumps the
+    generation; entries rendered under an older generation are never served.
+    ``ttl`` bounds how long a page may be served when the data is changed by
+    another process (e.g. a ``flask`` command) that cannot bump the counter.
+    """
+
+    def __init__(self, maxsize=256, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            generation, expires, value = entry
+            if generation != self.generation or (expires is not None and expires < time.monotonic()):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, generation):
+        """Store ``value`` rendered from the data of ``generation``."""
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = (generation, expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+
+class ValueCache(object):
+    """A single value loaded on first use and kept until invalidate() or ``ttl``."""
+
+    def __init__(self, loader, ttl=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.generation = 0
+        self._entry = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        entry = self._entry
+        if entry is not None:
+            generation, expires, value = entry
+            if generation == self.generation and (expires is None or expires >= time.monotonic()):
+                return value
+        generation = self.generation
+        value = self.loader()
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            # 加载期间被置为失效的值不保存
+            if generation == self.generation:
+                self._entry = (generation, expires, value)
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._entry = None
+
+
+class LRUCache(object):
+    """A bounded mapping that drops the least recently used entry, with an optional ``ttl``."""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -1,13 +1,31 @@
+import csv
+import itertools
+import json
+import os
+import random
+import time
+
 import click
+from sqlalchemy.exc import IntegrityError
 
-from watchlist import app, db
-from watchlist.models import User, Movie
+from watchlist import app, db, owner_cache, user_cache, template_sources_digest, TEMPLATES_DIGEST_FILE
+from watchlist.export import EXPORTERS, encode_chunks, gzip_chunks
+from watchlist.models import User, Movie, Revision, create_search_index, stream_movies, validate_movie_item, \
+    insert_movies, delete_duplicate_movies
+from watchlist.pragmas import effective_pragmas
 
 
 # Flask 命令行工具 
 # flask initdb 
 # flask forge 生成虚拟数据
 # flask admin 生成管理员账户
+# flask adduser 添加其他用户
+# flask upgrade 升级旧版本创建的数据库
+# flask compile-templates 预编译模板
+# flask import 从 CSV / NDJSON 文件导入电影
+# flask export 导出电影到 CSV / NDJSON 文件
+# flask dedupe 删除重复的电影
+# flask pragmas 查看数据库连接实际使用的 SQLite 参数
 
 @app.cli.command()
 @click.option('--username', prompt=True, help='The username used to login.')
@@ -27,9 +45,33 @@ def admin(username, password):
         user.set_password(password)
         db.session.add(user)
     
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        raise click.ClickException('Username %s is already taken.' % username)
+    user_cache.pop(user.id) # 用户名和密码变了
+    owner_cache.invalidate()
     click.echo('Done.')
 
+@app.cli.command()
+@click.option('--username', prompt=True, help='The username used to login.')
+@click.option('--password', prompt=True, hide_input=True, confirmation_prompt=True, help='The password used to login.')
+@click.option('--name', help='The name shown on the watchlist, defaults to the username.')
+def adduser(username, password, name):
+    """Create another user account."""
+    db.create_all()
+
+    user = User(username=username, name=name or username)
+    user.set_password(password)
+    db.session.add(user)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        raise click.ClickException('Username %s is already taken.' % username)
+    click.echo('Created user %s.' % username)
+
 @app.cli.command()
 @click.option('--drop', is_flag=True, help='Create after drop.')
 def initdb(drop):
@@ -39,28 +81,295 @@ def initdb(drop):
     db.create_all()
     click.echo('Initialized database.')
 
+# 生成大量测试数据时用来拼接片名的词
+TITLE_ADJECTIVES = (
+    'Silent', 'Last', 'Lost', 'Golden', 'Broken', 'Hidden', 'Crimson', 'Wild', 'Distant', 'Secret',
+    'Endless', 'Frozen', 'Burning', 'Forgotten', 'Little', 'Midnight', 'Paper', 'Quiet', 'Stolen', 'Velvet')
+TITLE_NOUNS = (
+    'River', 'Garden', 'Station', 'Summer', 'Kingdom', 'Mirror', 'Harbor', 'Letter', 'Island', 'Road',
+    'Forest', 'City', 'Window', 'Dream', 'Horizon', 'Lantern', 'Promise', 'Shadow', 'Train', 'Voyage')
+TITLE_PATTERNS = (
+    'The {adj} {noun}', '{adj} {noun}', '{noun} of the {adj} {noun2}', 'A {adj} {noun}',
+    'The {noun} and the {noun2}', '{adj} {noun} {number}')
+
+def generate_movies(seed, start=0):
+    """Yield reproducible {title, year} rows for the given seed, without end.
+
+    Every title ends with its sequence number, counted from ``start + 1``, so
+    no two rows of a run are the same movie.
+    """
+    rng = random.Random(seed)
+    for number in itertools.count(start + 1):
+        title = rng.choice(TITLE_PATTERNS).format(
+            adj=rng.choice(TITLE_ADJECTIVES),
+            noun=rng.choice(TITLE_NOUNS),
+            noun2=rng.choice(TITLE_NOUNS),
+            number=rng.randint(2, 9))
+        yield {'title': '%s #%d' % (title, number), 'year': rng.randint(1920, 2024)}
+
+def forge_movies(user_id, count, seed, batch_size):
+    """Bulk insert ``count`` generated movies for a user, one executemany and commit per batch.
+
+    Numbering continues after the user's existing movies, so a re-run adds new
+    rows. Titles that still clash with existing ones are dropped by the unique
+    index and made up for in the next batch; a batch that inserts nothing stops
+    the command instead of looping forever.
+    """
+    stmt = Movie.__table__.insert().prefix_with('OR IGNORE')
+    rows = generate_movies(seed, start=Movie.query.filter_by(user_id=user_id).count())
+    inserted = 0
+    start = time.perf_counter()
+    while inserted < count:
+        batch = []
+        for row in itertools.islice(rows, min(batch_size, count - inserted)):
+            row['user_id'] = user_id
+            batch.append(row)
+        added = db.session.execute(stmt, batch).rowcount
+        Revision.bump()
+        db.session.commit()
+        if not added:
+            raise click.ClickException('No new movies could be generated after %d of %d.' % (inserted, count))
+        inserted += added
+        click.echo('%d/%d movies (%.0f rows/s)' % (inserted, count, inserted / (time.perf_counter() - start)))
+    return inserted
+
+def find_user(username):
+    """Return the user named ``username``, or the site owner (first user) when it is None."""
+    if username is None:
+        return User.query.first()
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException('No user named %s.' % username)
+    return user
+
 @app.cli.command()
-def forge():
+@click.option('--username', help='Add the movies to this user, defaults to the site owner.')
+@click.option('--count', type=int, help='Generate this many synthetic movies instead of the sample list.')
+@click.option('--seed', default=0, show_default=True, help='Random seed, the same seed gives the same movies.')
+@click.option('--batch-size', default=10000, show_default=True, help='Rows inserted and committed at a time.')
+def forge(username, count, seed, batch_size):
     """Generate fake data."""
     db.create_all()
 
     name = 'Grey Li'
     movies = [
-        {'title': 'My Neighbor Totoro', 'year': '1988'},
-        {'title': 'Dead Poets Society', 'year': '1989'},
-        {'title': 'A Perfect World', 'year': '1993'},
-        {'title': 'Leon', 'year': '1994'},
-        {'title': 'Mahjong', 'year': '1996'},
-        {'title': 'Swallowtail Butterfly', 'year': '1996'},
-        {'title': 'King of Comedy', 'year': '1999'},
-        {'title': 'Devils on the Doorstep', 'year': '1999'},
-        {'title': 'WALL-E', 'year': '2008'},
-        {'title': 'The Pork of Music', 'year': '2012'},]
+        {'title': 'My Neighbor Totoro', 'year': 1988},
+        {'title': 'Dead Poets Society', 'year': 1989},
+        {'title': 'A Perfect World', 'year': 1993},
+        {'title': 'Leon', 'year': 1994},
+        {'title': 'Mahjong', 'year': 1996},
+        {'title': 'Swallowtail Butterfly', 'year': 1996},
+        {'title': 'King of Comedy', 'year': 1999},
+        {'title': 'Devils on the Doorstep', 'year': 1999},
+        {'title': 'WALL-E', 'year': 2008},
+        {'title': 'The Pork of Music', 'year': 2012},]
     
-    user = User(name=name)
-    db.session.add(user)
-    for m in movies:
-        movie = Movie(title=m['title'], year=m['year'])
-        db.session.add(movie)
+    user = find_user(username)
+    if user is None: # 还没有用户时创建站长
+        user = User(name=name)
+        db.session.add(user)
+        db.session.flush()
+    if count is None:
+        insert_movies(db.session, user.id, movies) # 重复执行时跳过已有的电影
+    Revision.bump()
     db.session.commit()
-    click.echo('Done')
\ No newline at end of file
+    owner_cache.invalidate()
+    if count:
+        forge_movies(user.id, count, seed, batch_size)
+    click.echo('Done')
+
+def upgrade_year_column(connection):
+    """Rebuild the movie table with an integer, indexed year column.
+
+    SQLite cannot change a column type in place, so the table is copied;
+    years that are not plain numbers become NULL. Returns the number of
+    duplicate movies left out of the copy, or None if the column was already
+    converted.
+    """
+    columns = {row['name']: row['type'] for row in connection.execute('PRAGMA table_info(movie)')}
+    if columns.get('year', '').upper() == 'INTEGER':
+        return None
+    connection.execute('ALTER TABLE movie RENAME TO movie_old')
+    # 索引名在整个数据库中唯一，先删掉旧表上的索引再建新表
+    for index in Movie.__table__.indexes:
+        connection.execute('DROP INDEX IF EXISTS %s' % index.name)
+    Movie.__table__.create(connection)
+    user_id = 'user_id' if 'user_id' in columns else 'NULL' # 没有 user_id 时由 upgrade_user_column 补上
+    year = "CASE WHEN trim(year) != '' AND trim(year) NOT GLOB '*[^0-9]*' THEN CAST(trim(year) AS INTEGER) END"
+    # 重复的电影只保留最早的一条；user_id 为 NULL 时唯一索引不起作用，所以先按分组筛选
+    total = connection.execute('SELECT count(*) FROM movie_old').scalar()
+    copied = connection.execute(
+        "INSERT OR IGNORE INTO movie (id, user_id, title, year) SELECT id, {user_id}, title, {year} "
+        "FROM movie_old WHERE id IN (SELECT min(id) FROM movie_old GROUP BY {user_id}, lower(trim(title)), {year}) "
+        "ORDER BY id".format(user_id=user_id, year=year)).rowcount
+    connection.execute('DROP TABLE movie_old')
+    connection.execute('DROP TABLE IF EXISTS movie_fts')
+    create_search_index(connection)
+    return total - copied
+
+def upgrade_user_column(connection):
+    """Add movie.user_id if it is missing and give the movies without a user to the site owner.
+
+    Returns the number of movies assigned.
+    """
+    columns = {row['name'] for row in connection.execute('PRAGMA table_info(movie)')}
+    if 'user_id' not in columns:
+        connection.execute('ALTER TABLE movie ADD COLUMN user_id INTEGER REFERENCES user (id)')
+    return connection.execute(
+        'UPDATE movie SET user_id = (SELECT min(id) FROM user) WHERE user_id IS NULL').rowcount
+
+# 旧版本在整张表上建的索引，已被以 user_id 开头的索引取代
+LEGACY_INDEXES = ('ix_movie_title', 'ix_movie_year', 'uq_movie_title_year')
+
+def upgrade_indexes(connection):
+    """Create the user and movie indexes missing from a database made by an older version."""
+    for name in LEGACY_INDEXES:
+        connection.execute('DROP INDEX IF EXISTS %s' % name)
+    existing = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    for table, hint in ((User.__table__, 'rename the users sharing a username'),
+                        (Movie.__table__, 'run "flask dedupe"')):
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            try:
+                index.create(connection)
+            except IntegrityError:
+                click.echo('Cannot create %s, %s first.' % (index.name, hint))
+                continue
+            click.echo('Created index %s.' % index.name)
+
+@app.cli.command()
+def upgrade():
+    """Upgrade a database created by an older version."""
+    db.create_all() # 创建缺少的表
+    with db.engine.begin() as connection:
+        connection.execute('BEGIN') # 建表、改表也放在同一事务中
+        dropped = upgrade_year_column(connection)
+        if dropped is not None:
+            click.echo('Converted movie.year to an indexed integer column.')
+            click.echo('Deleted %d duplicate movies.' % dropped)
+        assigned = upgrade_user_column(connection)
+        if assigned:
+            click.echo('Assigned %d movies to the site owner.' % assigned)
+        upgrade_indexes(connection)
+    click.echo('Upgraded database.')
+
+@app.cli.command()
+def dedupe():
+    """Delete duplicate movies, keeping the oldest of each."""
+    with db.engine.begin() as connection:
+        connection.execute('BEGIN')
+        deleted = delete_duplicate_movies(connection)
+        if deleted:
+            Revision.bump(connection)
+        upgrade_indexes(connection)
+    click.echo('Deleted %d duplicate movies.' % deleted)
+
+@app.cli.command('compile-templates')
+@click.option('--target', help='Output directory, defaults to COMPILED_TEMPLATES.')
+def compile_templates(target):
+    """Precompile the Jinja2 templates for production."""
+    target = target or app.config['COMPILED_TEMPLATES']
+    # 用原始的文件加载器，避免读到已经加载的旧的预编译模板
+    env = app.jinja_env.overlay(loader=app.create_global_jinja_loader())
+    names = env.list_templates()
+    env.compile_templates(target, zip=None, ignore_errors=False)
+    with open(os.path.join(target, TEMPLATES_DIGEST_FILE), 'w') as f:
+        f.write(template_sources_digest())
+    click.echo('Compiled %d templates into %s.' % (len(names), target))
+
+def read_movie_file(file, fmt):
+    """Yield decoded rows of a CSV (title,year header) or NDJSON file, None for undecodable lines."""
+    if fmt == 'csv':
+        for row in csv.DictReader(file):
+            yield row
+        return
+    for line in file:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+@app.cli.command('import')
+@click.argument('file', type=click.File('r', encoding='utf-8-sig')) # 兼容 Excel 等工具写入的 BOM
+@click.option('--username', help='Add the movies to this user, defaults to the site owner.')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), help='Defaults to the file extension.')
+@click.option('--chunk-size', default=5000, show_default=True, help='Rows inserted and committed at a time.')
+def import_movies(file, username, fmt, chunk_size):
+    """Import movies from a CSV or NDJSON file."""
+    if fmt is None:
+        fmt = 'csv' if os.path.splitext(file.name)[1].lower() == '.csv' else 'ndjson'
+    db.create_all()
+    user = find_user(username)
+    if user is None:
+        raise click.ClickException('No user yet, run "flask admin" first.')
+    user_id = user.id
+
+    imported = invalid = duplicate = 0
+    chunk = []
+    start = time.perf_counter()
+
+    def flush():
+        # 每块一条 executemany 语句、一次提交，已存在的电影跳过
+        inserted = sum(insert_movies(db.session, user_id, chunk))
+        Revision.bump()
+        db.session.commit()
+        del chunk[:]
+        return inserted
+
+    for item in read_movie_file(file, fmt):
+        try:
+            chunk.append(validate_movie_item(item))
+        except ValueError:
+            invalid += 1
+            continue
+        if len(chunk) >= chunk_size:
+            size = len(chunk)
+            inserted = flush()
+            imported += inserted
+            duplicate += size - inserted
+            click.echo('%d rows imported...' % imported)
+    if chunk:
+        size = len(chunk)
+        inserted = flush()
+        imported += inserted
+        duplicate += size - inserted
+
+    elapsed = time.perf_counter() - start
+    rows = imported + invalid + duplicate
+    click.echo('Imported %d rows, skipped %d invalid rows and %d duplicates in %.2fs (%.0f rows/s).' % (
+        imported, invalid, duplicate, elapsed, rows / elapsed if elapsed else 0))
+
+@app.cli.command('export')
+@click.argument('output', type=click.File('wb'))
+@click.option('--username', help='Export the list of this user, defaults to the site owner.')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), help='Defaults to the file extension.')
+@click.option('--gzip', 'compress', is_flag=True, help='Gzip the output, implied by a .gz extension.')
+def export_movies(output, username, fmt, compress):
+    """Export movies to a CSV or NDJSON file ('-' for stdout)."""
+    user = find_user(username)
+    if user is None:
+        raise click.ClickException('No user yet, run "flask admin" first.')
+    name = getattr(output, 'name', None)
+    name = name if isinstance(name, str) else ''
+    if name.lower().endswith('.gz'):
+        compress = True
+        name = name[:-3]
+    if fmt is None:
+        fmt = 'csv' if name.lower().endswith('.csv') else 'ndjson'
+
+    exporter = EXPORTERS[fmt][0]
+    chunks = exporter(stream_movies(user.id))
+    chunks = gzip_chunks(chunks) if compress else encode_chunks(chunks)
+    for data in chunks:
+        output.write(data)
+    output.flush()
+
+@app.cli.command()
+def pragmas():
+    """Show the SQLite pragmas in effect on a new connection."""
+    with db.engine.connect() as connection:
+        for name, value in effective_pragmas(connection):
+            click.echo('%s = %s' % (name, value))
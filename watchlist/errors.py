@@ -5,4 +5,18 @@ from watchlist import app
 
 @app.errorhandler(404)
 def page_not_found(e):
-    return render_template('errors/404.html'), 404
\ No newline at end of file
+    return render_template('errors/404.html'), 404
+
+@app.errorhandler(429)
+def too_many_requests(e):
+    response = e.get_response()
+    response.set_data(render_template('errors/429.html'))
+    response.mimetype = 'text/html'
+    return response
+
+@app.errorhandler(503)
+def service_unavailable(e):
+    response = e.get_response()
+    response.set_data(render_template('errors/503.html'))
+    response.mimetype = 'text/html'
+    return response
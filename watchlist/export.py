@@ -0,0 +1,56 @@
+import csv
+import io
+import json
+import zlib
+
+
+# 每积累约这么多字符输出一块，避免逐行发送
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_csv(rows, chunk_size=CHUNK_SIZE):
+    """Yield CSV text in chunks, with the same title,year header ``flask import`` reads."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(('title', 'year'))
+    for row in rows:
+        writer.writerow((row.title, row.year))
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_ndjson(rows, chunk_size=CHUNK_SIZE):
+    """Yield newline-delimited JSON objects in chunks."""
+    lines, size = [], 0
+    for row in rows:
+        line = json.dumps({'title': row.title, 'year': row.year}, ensure_ascii=False) + '\n'
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield ''.join(lines)
+            lines, size = [], 0
+    yield ''.join(lines)
+
+
+def gzip_chunks(chunks, level=6):
+    """Compress text chunks into a gzip stream on the fly."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def encode_chunks(chunks):
+    for chunk in chunks:
+        yield chunk.encode('utf-8')
+
+
+EXPORTERS = {
+    'csv': (iter_csv, 'text/csv'),
+    'ndjson': (iter_ndjson, 'application/x-ndjson'),
+}
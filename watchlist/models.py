@@ -1,22 +1,301 @@
+import secrets
+from collections import namedtuple
+from datetime import datetime
+
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event, func, select
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
 
-from watchlist import db
+from watchlist import app, db
 
 
 class User(db.Model, UserMixin): # 自动创建表 user
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(20))
 
-    username = db.Column(db.String(20)) # 用户名
+    username = db.Column(db.String(20), unique=True, index=True) # 用户名，登录时按索引查找
     password_hash = db.Column(db.String(128))
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, *password_hash_options())
     def validate_password(self, password):
         return check_password_hash(self.password_hash, password)
+    def needs_rehash(self):
+        """Whether the stored hash was made with other settings than the configured ones."""
+        method, salt_length = password_hash_options()
+        if method.startswith('pbkdf2:') and method.count(':') == 1:
+            method = '%s:%d' % (method, DEFAULT_PBKDF2_ITERATIONS) # werkzeug 会把默认迭代次数写进哈希
+        parts = (self.password_hash or '').split('$')
+        return len(parts) != 3 or parts[0] != method or len(parts[1]) != salt_length
+
+def password_hash_options():
+    """Return (method, salt_length) for generate_password_hash from the app config."""
+    return app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH']
+
+_dummy_password_hashes = {}
+
+def dummy_password_hash():
+    """Return a hash of a random password made with the configured settings.
+
+    Login checks unknown usernames against it, so they take as long as a
+    wrong password and the response time does not tell which usernames exist.
+    """
+    options = password_hash_options()
+    if options not in _dummy_password_hashes: # 每种哈希设置只计算一次
+        _dummy_password_hashes[options] = generate_password_hash(secrets.token_urlsafe(16), *options)
+    return _dummy_password_hashes[options]
+
+class Profile(UserMixin, namedtuple('Profile', 'id name username')):
+    """Read-only snapshot of a User, safe to keep across requests and sessions.
+
+    Also serves as ``current_user``, so views change the user through a query
+    rather than by setting attributes on it.
+    """
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.name, user.username)
 
 class Movie(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id')) # 所属用户
     title = db.Column(db.String(60))
-    year = db.Column(db.String(4))
+    year = db.Column(db.Integer)
+
+    # 每个用户的列表只读取自己的索引范围：按 id / 片名 / 年份排序和过滤都以 user_id 开头
+    # 同一用户的同一部电影（忽略大小写和首尾空格的片名 + 年份）只能有一条，重复插入时由索引直接拒绝
+    __table_args__ = (
+        db.Index('ix_movie_user_id_id', user_id, id),
+        db.Index('ix_movie_user_id_title', user_id, title),
+        db.Index('ix_movie_user_id_year', user_id, year),
+        db.Index('uq_movie_user_title_year', user_id, func.lower(func.trim(title)), year, unique=True),
+    )
+
+    @classmethod
+    def select_rows(cls):
+        """Core select of the listed columns.
+
+        Rows come back as plain read-only tuples with attribute access, skipping
+        ORM instance construction and the session identity map.
+        """
+        return select([cls.id, cls.title, cls.year])
+
+    @classmethod
+    def select_user_rows(cls, user_id):
+        """select_rows() limited to the movies of one user."""
+        return cls.select_rows().where(cls.user_id == user_id)
+
+    @classmethod
+    def title_key(cls):
+        """SQL expression of the normalised title used by the (title, year) unique index."""
+        return func.lower(func.trim(cls.title))
+
+# SQLite 的 lower() 和 trim() 只处理 ASCII 字母和空格，Python 端保持一致
+ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+
+def title_key(title):
+    """Python version of Movie.title_key() for a single title."""
+    return title.strip(' ').translate(ASCII_LOWER)
+
+
+def validate_year(year, required=True):
+    """Check a year from form input, return it as an int or raise ValueError.
+
+    An empty year gives None when it is not ``required``.
+    """
+    year = (year or '').strip()
+    if not year and not required:
+        return None
+    if not (year.isascii() and year.isdigit()) or len(year) > 4: # isdigit 也认其他文字的数字，如 '٣'
+        raise ValueError('Invalid input.')
+    return int(year)
+
+
+def validate_movie(title, year, year_required=True):
+    """Check movie form input, return (title, year as int or None) or raise ValueError."""
+    if not title or len(title) > 60:
+        raise ValueError('Invalid input.')
+    return title, validate_year(year, required=year_required)
+
+
+def validate_movie_item(item):
+    """Check a decoded {title, year} mapping from an API or file, return a row dict."""
+    if not isinstance(item, dict) or not isinstance(item.get('title'), str):
+        raise ValueError('Invalid input.')
+    title, year = validate_movie(item['title'], str(item.get('year', '')))
+    return {'title': title, 'year': year}
+
+
+def iter_rows(result, size=1000):
+    """Yield rows of ``result`` fetching ``size`` at a time."""
+    while True:
+        rows = result.fetchmany(size)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+# 单条语句完成的写操作，既可以在请求的 session 中执行，也可以交给写队列批量提交
+# 都只作用于 user_id 的电影，别人的电影当作不存在
+def insert_movie(bind, user_id, title, year):
+    """Insert a movie, return its id, or None if the user already has the same movie."""
+    result = bind.execute(Movie.__table__.insert().prefix_with('OR IGNORE').values(
+        user_id=user_id, title=title, year=year))
+    if not result.rowcount:
+        return None
+    return result.inserted_primary_key[0]
+
+
+def update_movie(bind, user_id, movie_id, title, year):
+    """Update a movie, return the number of rows changed (0 if it does not exist)."""
+    return bind.execute(Movie.__table__.update().where(
+        (Movie.user_id == user_id) & (Movie.id == movie_id)).values(title=title, year=year)).rowcount
+
+
+def delete_movie(bind, user_id, movie_id):
+    """Delete a movie, return the number of rows deleted (0 if it does not exist)."""
+    return bind.execute(Movie.__table__.delete().where(
+        (Movie.user_id == user_id) & (Movie.id == movie_id))).rowcount
+
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def delete_movies(bind, user_id, movie_ids, chunk_size=500):
+    """Delete the given movies with one ``WHERE id IN (...)`` per chunk, return the rows deleted."""
+    table = Movie.__table__
+    return sum(bind.execute(table.delete().where(
+        (table.c.user_id == user_id) & table.c.id.in_(chunk))).rowcount
+        for chunk in chunked(movie_ids, chunk_size))
+
+
+def update_movies_year(bind, user_id, movie_ids, year, chunk_size=500):
+    """Set the year of the given movies with one ``WHERE id IN (...)`` per chunk, return the rows changed.
+
+    Movies that would become a duplicate of an existing one are left unchanged.
+    """
+    table = Movie.__table__
+    stmt = table.update().prefix_with('OR IGNORE')
+    return sum(bind.execute(stmt.where((table.c.user_id == user_id) & table.c.id.in_(chunk))
+                            .values(year=year)).rowcount
+               for chunk in chunked(movie_ids, chunk_size))
+
+
+def insert_movies(bind, user_id, rows, chunk_size=500):
+    """Insert many {title, year} rows into the list of ``user_id`` with executemany, skipping duplicates.
+
+    Returns one flag per row, True if it was inserted. Existing movies are
+    found with one index lookup per chunk and repeats inside ``rows`` are
+    skipped before inserting; INSERT OR IGNORE still guards against rows
+    added concurrently.
+    """
+    table = Movie.__table__
+    seen = set()
+    inserted = []
+    for chunk in chunked(rows, chunk_size):
+        keys = {title_key(row['title']) for row in chunk}
+        existing = bind.execute(select([Movie.title_key(), table.c.year]).where(
+            (table.c.user_id == user_id) & Movie.title_key().in_(keys))).fetchall()
+        seen.update((key, year) for key, year in existing)
+
+        new_rows = []
+        for row in chunk:
+            key = (title_key(row['title']), row['year'])
+            inserted.append(key not in seen)
+            if key not in seen:
+                seen.add(key)
+                new_rows.append(dict(row, user_id=user_id))
+        if new_rows:
+            bind.execute(table.insert().prefix_with('OR IGNORE'), new_rows)
+    return inserted
+
+
+def delete_duplicate_movies(bind):
+    """Keep the oldest of every group of duplicate movies in a single statement, return the rows deleted."""
+    table = Movie.__table__
+    keep = select([func.min(table.c.id)]).group_by(table.c.user_id, Movie.title_key(), table.c.year)
+    return bind.execute(table.delete().where(table.c.id.notin_(keep))).rowcount
+
+
+def stream_movies(user_id, size=1000):
+    """Iterate over every movie row of a user in id order without loading them all at once."""
+    result = db.session.execute(Movie.select_user_rows(user_id).order_by(Movie.id)
+                                .execution_options(stream_results=True))
+    return iter_rows(result, size)
+
+
+class Revision(db.Model): # 记录电影列表的修改版本，用于条件请求（ETag / Last-Modified）
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @classmethod
+    def bump(cls, bind=None):
+        """Mark the movie list as changed, inside the caller's transaction.
+
+        ``bind`` is a Connection to use instead of the request session.
+        """
+        bind = bind if bind is not None else db.session
+        now = datetime.utcnow()
+        result = bind.execute(cls.__table__.update().where(cls.id == 1).values(
+            version=cls.version + 1, updated_at=now))
+        if result.rowcount == 0:
+            bind.execute(cls.__table__.insert().values(id=1, version=1, updated_at=now))
+
+    @classmethod
+    def current(cls):
+        """Return (version, updated_at) of the movie list with one primary key lookup."""
+        row = db.session.query(cls.version, cls.updated_at).filter(cls.id == 1).first()
+        if row is None:
+            return 0, None
+        return row.version, row.updated_at
+
+
+class SessionData(db.Model): # 服务端会话存储（SESSION_BACKEND=sqlite 时使用）
+    id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expires = db.Column(db.Float, nullable=False, index=True)
+
+
+@event.listens_for(Revision.__table__, 'after_create')
+def init_revision(target, connection, **kw):
+    connection.execute(target.insert().values(id=1, version=0, updated_at=datetime.utcnow()))
+
+
+# 标题全文索引（SQLite FTS5），内容取自 movie 表，由触发器保持同步
+SEARCH_INDEX_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS movie_fts USING fts5(title, content='movie', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS movie_fts_ai AFTER INSERT ON movie BEGIN "
+    "INSERT INTO movie_fts(rowid, title) VALUES (new.id, new.title); END",
+    "CREATE TRIGGER IF NOT EXISTS movie_fts_ad AFTER DELETE ON movie BEGIN "
+    "INSERT INTO movie_fts(movie_fts, rowid, title) VALUES ('delete', old.id, old.title); END",
+    "CREATE TRIGGER IF NOT EXISTS movie_fts_au AFTER UPDATE OF title ON movie BEGIN "
+    "INSERT INTO movie_fts(movie_fts, rowid, title) VALUES ('delete', old.id, old.title); "
+    "INSERT INTO movie_fts(rowid, title) VALUES (new.id, new.title); END",
+)
+
+
+def create_search_index(connection):
+    """Create the title search index and its triggers, filling it from existing rows."""
+    exists = connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'movie_fts'").first()
+    for statement in SEARCH_INDEX_DDL:
+        connection.execute(statement)
+    if not exists:
+        connection.execute("INSERT INTO movie_fts(movie_fts) VALUES ('rebuild')")
+
+
+@event.listens_for(db.metadata, 'after_create')
+def after_create_all(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        create_search_index(connection)
+
+
+@event.listens_for(db.metadata, 'before_drop')
+def before_drop_all(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute('DROP TABLE IF EXISTS movie_fts')
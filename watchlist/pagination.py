@@ -0,0 +1,153 @@
+import base64
+import json
+
+from flask import current_app
+from sqlalchemy import and_, or_, tuple_
+
+from watchlist import db
+from watchlist.models import Movie
+
+
+# 可排序的列，排序时总是以 id 作为第二排序键，保证顺序唯一
+SORT_COLUMNS = {
+    'id': Movie.id,
+    'title': Movie.title,
+    'year': Movie.year,
+}
+
+
+def encode_cursor(values):
+    """Pack the sort key of a row into an opaque, url-safe token."""
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Unpack a token made by encode_cursor, raise ValueError if it is malformed."""
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError('Invalid cursor.') from e
+    if not isinstance(values, list) or not values:
+        raise ValueError('Invalid cursor.')
+    return values
+
+
+class Page(object):
+    """One slice of a keyset paginated listing."""
+
+    def __init__(self, items, sort, per_page, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.sort = sort
+        self.per_page = per_page
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+# SQLite 整数的范围，超出时 sqlite3 会抛出 OverflowError
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+# 游标中排序列的值的类型（id 总是整数），这些列可能为 NULL
+CURSOR_TYPES = {
+    'title': str,
+    'year': int,
+}
+
+
+def check_cursor_value(value, kind, nullable=False):
+    """Raise ValueError unless ``value`` can be bound as a value of a column of ``kind``."""
+    if value is None and nullable:
+        return value
+    if kind is int:
+        if isinstance(value, bool) or not isinstance(value, int) or not INT64_MIN <= value <= INT64_MAX:
+            raise ValueError('Invalid cursor.')
+    elif not isinstance(value, kind):
+        raise ValueError('Invalid cursor.')
+    return value
+
+
+def clamp_per_page(per_page):
+    default = current_app.config['MOVIES_PER_PAGE']
+    maximum = current_app.config['MOVIES_MAX_PER_PAGE']
+    if not per_page or per_page < 1:
+        return default
+    return min(per_page, maximum)
+
+
+def _row_key(row, sort):
+    if sort == 'id':
+        return [row.id]
+    return [getattr(row, sort), row.id]
+
+
+def paginate_movies(stmt, sort='id', after=None, before=None, per_page=None):
+    """Return a Page of the select ``stmt`` ordered by ``sort`` using keyset pagination.
+
+    ``after``/``before`` are cursors from a previous Page. Each call reads at
+    most ``per_page + 1`` rows through the (sort column, id) index, no matter
+    how deep into the list the cursor points.
+    """
+    if sort not in SORT_COLUMNS:
+        raise ValueError('Unknown sort column.')
+    per_page = clamp_per_page(per_page)
+
+    column = SORT_COLUMNS[sort]
+    order = [Movie.id] if sort == 'id' else [column, Movie.id]
+
+    def bound(cursor):
+        values = decode_cursor(cursor)
+        if len(values) != len(order):
+            raise ValueError('Invalid cursor.')
+        check_cursor_value(values[-1], int) # 最后一个总是 id
+        if sort != 'id':
+            check_cursor_value(values[0], CURSOR_TYPES[sort], nullable=True)
+        return values
+
+    # SQLite 排序时 NULL 在最前面，而与 NULL 比较的结果是 NULL，需要单独处理
+    def after_clause(values):
+        if sort == 'id':
+            return Movie.id > values[0]
+        value, movie_id = values
+        if value is None:
+            return or_(and_(column.is_(None), Movie.id > movie_id), column.isnot(None))
+        return and_(column.isnot(None), tuple_(column, Movie.id) > tuple_(value, movie_id))
+
+    def before_clause(values):
+        if sort == 'id':
+            return Movie.id < values[0]
+        value, movie_id = values
+        if value is None:
+            return and_(column.is_(None), Movie.id < movie_id)
+        return or_(column.is_(None), tuple_(column, Movie.id) < tuple_(value, movie_id))
+
+    if before:
+        stmt = stmt.where(before_clause(bound(before))).order_by(*[c.desc() for c in order])
+        rows = db.session.execute(stmt.limit(per_page + 1)).fetchall()
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        rows.reverse()
+        has_prev, has_next = more, True
+    else:
+        if after:
+            stmt = stmt.where(after_clause(bound(after)))
+        rows = db.session.execute(stmt.order_by(*order).limit(per_page + 1)).fetchall()
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        has_prev, has_next = bool(after), more
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if has_next:
+            next_cursor = encode_cursor(_row_key(rows[-1], sort))
+        if has_prev:
+            prev_cursor = encode_cursor(_row_key(rows[0], sort))
+    return Page(rows, sort, per_page, next_cursor, prev_cursor)
@@ -0,0 +1,49 @@
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from watchlist import app
+
+
+# 允许的取值，环境变量中的值会直接拼进 PRAGMA 语句，先做检查
+CHOICES = {
+    'journal_mode': ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'),
+    'synchronous': ('OFF', 'NORMAL', 'FULL', 'EXTRA'),
+    'temp_store': ('DEFAULT', 'FILE', 'MEMORY'),
+}
+INTEGERS = ('busy_timeout', 'cache_size', 'mmap_size')
+# busy_timeout 放在最前，后面的 PRAGMA 遇到锁时也会等待
+ORDER = ('busy_timeout', 'journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store')
+
+
+def pragma_statements(pragmas):
+    """Return the PRAGMA statements for the configured values, skipping empty ones."""
+    statements = []
+    for name in ORDER:
+        value = pragmas.get(name)
+        if value is None or value == '':
+            continue
+        if name in INTEGERS:
+            value = int(value)
+        else:
+            value = str(value).upper()
+            if value not in CHOICES[name]:
+                raise ValueError('Invalid value for SQLite pragma %s: %r' % (name, value))
+        statements.append('PRAGMA %s = %s' % (name, value))
+    return statements
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for statement in pragma_statements(app.config['SQLITE_PRAGMAS']):
+        cursor.execute(statement)
+    cursor.close()
+
+
+def effective_pragmas(connection):
+    """Read back the value SQLite actually uses for every tunable pragma."""
+    return [(name, connection.execute('PRAGMA %s' % name).scalar()) for name in ORDER]
@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import abort, current_app, request
+
+# 与 User.username 的列宽一致，更长的用户名不可能存在，不为它们建桶
+MAX_USERNAME_LENGTH = 20
+
+
+class TokenBucketLimiter(object):
+    """Token buckets keyed by any hashable value, held in a bounded LRU mapping.
+
+    Each key may spend ``burst`` requests at once and regains ``rate`` tokens
+    per second. A bucket left idle until it is full again is the same as a new
+    one, so it is dropped; past ``maxsize`` keys the least recently seen bucket
+    is dropped too, which keeps memory flat however many clients show up.
+    """
+
+    def __init__(self, rate, burst, maxsize=100000):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.maxsize = maxsize
+        self.idle = self.burst / self.rate if self.rate > 0 else None
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, now=None):
+        """Take one token for ``key``; return None if allowed, else seconds until the next token."""
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens, stamp = bucket
+                tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = None
+            else:
+                wait = (1 - tokens) / self.rate if self.rate > 0 else 0
+            self._buckets[key] = (tokens, now)
+            self._evict(now)
+        return wait
+
+    def _evict(self, now):
+        # 最久未访问的桶在最前面，依次清掉已空闲到装满的和超出上限的
+        buckets = self._buckets
+        while buckets:
+            key, (tokens, stamp) = next(iter(buckets.items()))
+            if len(buckets) > self.maxsize or (self.idle is not None and now - stamp >= self.idle):
+                del buckets[key]
+            else:
+                break
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+def rate_limit(limiter, username_field=None):
+    """Answer POST requests with 429 once the client IP (or posted username) runs out of tokens.
+
+    Put it right under ``@app.route`` so it runs before ``login_required`` or
+    the view touches the database.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method == 'POST' and current_app.config['RATELIMIT_ENABLED']:
+                keys = [('ip', request.remote_addr)]
+                if username_field is not None:
+                    username = (request.form.get(username_field) or '').strip().lower()
+                    if username and len(username) <= MAX_USERNAME_LENGTH:
+                        keys.append(('username', username))
+                for key in keys:
+                    wait = limiter.hit(key)
+                    if wait is not None:
+                        abort(429, retry_after=int(wait) + 1 if wait else None)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
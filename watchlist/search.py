@@ -0,0 +1,46 @@
+import re
+
+from flask import current_app
+from sqlalchemy import text
+
+from watchlist import db
+from watchlist.pagination import clamp_per_page
+
+
+SEARCH_SQL = text(
+    'SELECT movie.id, movie.title, movie.year FROM movie_fts '
+    'JOIN movie ON movie.id = movie_fts.rowid '
+    'WHERE movie_fts MATCH :match AND movie.user_id = :user_id ORDER BY movie_fts.rank, movie.id '
+    'LIMIT :limit OFFSET :offset')
+
+
+def match_expression(q):
+    """Turn free text into an FTS5 query: every word must match as a prefix.
+
+    Words are quoted so that FTS5 operators typed by the user (AND, NEAR, *,
+    column filters) are treated as plain text.
+    """
+    words = re.findall(r'\w+', q)
+    return ' '.join('"%s"*' % word for word in words)
+
+
+def search_movies(q, user_id, page=1, per_page=None):
+    """Return (rows, has_next) for one page of the user's titles matching ``q``, best match first.
+
+    Raises ValueError for a page past SEARCH_MAX_PAGE.
+    """
+    max_page = current_app.config['SEARCH_MAX_PAGE']
+    page = max(page, 1)
+    if page > max_page:
+        raise ValueError('Page out of range.')
+    match = match_expression(q)
+    if not match:
+        return [], False
+    per_page = clamp_per_page(per_page)
+    rows = db.session.execute(SEARCH_SQL, {
+        'match': match,
+        'user_id': user_id,
+        'limit': per_page + 1,
+        'offset': (page - 1) * per_page,
+    }).fetchall()
+    return rows[:per_page], len(rows) > per_page and page < max_page
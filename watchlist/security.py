@@ -0,0 +1,40 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class HashPoolBusy(Exception):
+    """Raised when every worker and queue slot of a HashPool is taken."""
+
+
+class HashPool(object):
+    """Run password hashing on a small, bounded thread pool.
+
+    At most ``workers`` hashes are computed at once and at most ``backlog``
+    more may wait; further calls fail fast with HashPoolBusy instead of
+    piling up, so a login storm cannot take every request worker.
+    """
+
+    def __init__(self, workers=2, backlog=8):
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(workers + backlog)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def run(self, fn, *args, timeout=None):
+        if not self._slots.acquire(blocking=False):
+            raise HashPoolBusy()
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future.result(timeout)
+
+    def _get_executor(self):
+        # 第一次使用时才创建线程
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+        return self._executor
@@ -0,0 +1,170 @@
+import copy
+import secrets
+import threading
+import time
+
+from flask.sessions import SecureCookieSessionInterface, SessionInterface, SessionMixin, session_json_serializer
+from sqlalchemy import select
+from werkzeug.datastructures import CallbackDict
+
+from watchlist.cache import LRUCache
+
+
+class CookieSessionInterface(SecureCookieSessionInterface):
+    """The default signed cookie session, without building a serializer for requests that carry no cookie."""
+
+    def open_session(self, app, request):
+        # 匿名访问通常没有会话 cookie，直接返回空会话
+        if not request.cookies.get(app.session_cookie_name):
+            return self.session_class()
+        return super(CookieSessionInterface, self).open_session(app, request)
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session data kept on the server, the cookie only carries ``sid``.
+
+    ``expires`` is when the stored copy runs out and ``opened_user_id`` the
+    logged in user it was loaded with, both None for a new session.
+    """
+
+    def __init__(self, initial=None, sid=None, expires=None):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = sid is None
+        self.expires = expires
+        self.opened_user_id = self.get('_user_id')
+        self.modified = False
+
+
+class MemorySessionStore(object):
+    """Sessions in a bounded in-process LRU map; lost on restart and not shared between processes."""
+
+    def __init__(self, maxsize=10000):
+        self._cache = LRUCache(maxsize=maxsize)
+
+    def get(self, sid):
+        """Return ``(data, expires)`` for a live session, else None."""
+        entry = self._cache.get(sid)
+        if entry is None:
+            return None
+        expires, data = entry
+        if expires < time.time():
+            self._cache.pop(sid)
+            return None
+        return copy.deepcopy(data), expires
+
+    def save(self, sid, data, expires):
+        # 保存副本，避免请求中原地修改的列表（如 flash 消息）影响已保存的数据
+        self._cache.set(sid, (expires, copy.deepcopy(data)))
+
+    def delete(self, sid):
+        self._cache.pop(sid)
+
+
+class SqliteSessionStore(object):
+    """Sessions in the ``session_data`` table, shared by every process using the database.
+
+    Expired rows are skipped on read and deleted every ``purge_every`` saves.
+    """
+
+    def __init__(self, get_engine, purge_every=1000):
+        self.get_engine = get_engine
+        self.purge_every = purge_every
+        self._saves = 0
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        """Return ``(data, expires)`` for a live session, else None."""
+        from watchlist.models import SessionData
+        table = SessionData.__table__
+        row = self.get_engine().execute(select([table.c.data, table.c.expires]).where(
+            (table.c.id == sid) & (table.c.expires >= time.time()))).first()
+        if row is None:
+            return None
+        try:
+            return session_json_serializer.loads(row.data), row.expires
+        except ValueError:
+            return None
+
+    def save(self, sid, data, expires):
+        from watchlist.models import SessionData
+        table = SessionData.__table__
+        with self._lock:
+            self._saves += 1
+            purge = self._saves % self.purge_every == 0
+        with self.get_engine().begin() as connection:
+            connection.execute(table.insert().prefix_with('OR REPLACE').values(
+                id=sid, data=session_json_serializer.dumps(dict(data)), expires=expires))
+            if purge:
+                connection.execute(table.delete().where(table.c.expires < time.time()))
+
+    def delete(self, sid):
+        from watchlist.models import SessionData
+        table = SessionData.__table__
+        with self.get_engine().begin() as connection:
+            connection.execute(table.delete().where(table.c.id == sid))
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Keep the session in ``store`` and put only a random id in the cookie.
+
+    Nothing is serialized or signed per response: the store is written only
+    when the session changed or less than half of its lifetime is left, and
+    the cookie is sent again only for a new id or when a permanent session has
+    to be refreshed. Unpermanent sessions expire from the store after ``ttl``
+    seconds without a visit. Logging in or out moves the data to a new id and
+    drops the old one, so an id planted before login is worthless afterwards.
+    """
+
+    def __init__(self, store, ttl=86400):
+        self.store = store
+        self.ttl = ttl
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            entry = self.store.get(sid)
+            if entry is not None:
+                data, expires = entry
+                return ServerSideSession(data, sid=sid, expires=expires)
+        return ServerSideSession()
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified and session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+
+        new = session.new
+        if not new and session.get('_user_id') != session.opened_user_id:
+            # 登录用户变了（登录、登出、切换用户），换新的会话 id，防止会话固定攻击
+            self.store.delete(session.sid)
+            new = True
+        if new:
+            session.sid = secrets.token_urlsafe(32)
+        if session.permanent:
+            ttl = app.permanent_session_lifetime.total_seconds()
+        else:
+            ttl = self.ttl
+        now = time.time()
+        # 剩余时间不到一半时延长有效期，经常访问的会话不会过期
+        stale = session.expires is not None and session.expires - now < ttl / 2
+        if session.modified or new or stale or (session.permanent and app.config['SESSION_REFRESH_EACH_REQUEST']):
+            self.store.save(session.sid, dict(session), now + ttl)
+        if new or self.should_set_cookie(app, session) and session.permanent:
+            response.set_cookie(
+                app.session_cookie_name,
+                session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
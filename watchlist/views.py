@@ -1,66 +1,305 @@
-from flask import render_template, redirect, flash, url_for, request
+import json
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from flask import render_template, redirect, flash, url_for, request, abort, session, make_response, \
+    get_flashed_messages, stream_with_context, Response, jsonify
 from flask_login import login_required, login_user, logout_user, current_user
+from sqlalchemy.exc import IntegrityError
+from werkzeug.http import is_resource_modified
+from werkzeug.security import generate_password_hash, check_password_hash
 
-from watchlist import app, db
-from watchlist.models import User, Movie
+from watchlist import app, db, page_cache, owner_cache, user_cache, write_queue, hash_pool, \
+    login_limiter, write_limiter
+from watchlist.export import EXPORTERS, gzip_chunks
+from watchlist.models import User, Profile, Movie, password_hash_options, dummy_password_hash, Revision, stream_movies, validate_movie, validate_movie_item, validate_year, \
+    insert_movie, insert_movies, update_movie, delete_movie, delete_movies, update_movies_year
+from watchlist.pagination import paginate_movies
+from watchlist.ratelimit import rate_limit
+from watchlist.search import search_movies
+from watchlist.security import HashPoolBusy
 
 
-@app.route("/", methods=['GET', 'POST']) 
-def index():
+@app.route("/", methods=['GET', 'POST'], defaults={'username': None})
+@app.route('/u/<username>') # 公开的个人列表，只读
+@rate_limit(write_limiter) # 限流在查询用户之前
+def index(username):
     """Add a item"""
 
     if request.method == 'POST':
         if not current_user.is_authenticated:
             return redirect(url_for('index'))
 
-        title = request.form.get('title')
-        year = request.form.get('year')
-
-        if not title or not year or len(year) > 4 or len(title) > 60:
+        try:
+            title, year = validate_movie(request.form.get('title'), request.form.get('year'))
+        except ValueError:
             flash('Invalid input.') #错误提示
             return redirect(url_for('index')) # 重定向回主页
         
-        movie = Movie(title=title, year=year)
-        db.session.add(movie)
-        db.session.commit()
+        # 同一部电影已存在时唯一索引会忽略这次插入
+        if write_movie(insert_movie, current_user.id, title, year) is None:
+            flash('Item already exists.')
+            return redirect(url_for('index'))
         flash('Item created.') #显示成功创建提示
         return redirect(url_for('index'))
 
     # user = User.query.first() # 没有上下文处理函数则要此变量
-    movies = Movie.query.all()
-    return render_template('index.html', 
-    movies = movies)
+    # 有提示消息时页面内容因请求而异，不能缓存
+    cacheable = '_flashes' not in session
+    cache_key = (current_user.get_id(), request.full_path) # 已登录的用户各自看到自己的列表
+    if cacheable:
+        cached = page_cache.get(cache_key)
+        if cached is not None:
+            return conditional_response(*cached)
+    generation = page_cache.generation
+
+    # 先确认列表主人存在，不存在的用户名即使带着 ETag 也返回 404
+    owner = find_owner(username)
+
+    # 浏览器或代理已有最新版本时，不查询电影也不渲染模板，直接返回 304
+    version, last_modified = Revision.current()
+    etag = '%d-%s-%d' % (version, current_user.get_id() or 0, owner.id)
+    if cacheable and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return conditional_response('', etag, last_modified)
+
+    # 只读取列表主人的电影，年份范围过滤走 (user_id, year) 索引
+    stmt = Movie.select_user_rows(owner.id)
+    year_from = request.args.get('year_from', type=int)
+    year_to = request.args.get('year_to', type=int)
+    for year in (year_from, year_to):
+        if year is not None and not 0 <= year <= 9999: # 年份最多 4 位，超出范围的数传给 SQLite 会溢出
+            abort(400)
+    if year_from is not None:
+        stmt = stmt.where(Movie.year >= year_from)
+    if year_to is not None:
+        stmt = stmt.where(Movie.year <= year_to)
+
+    # 按游标分页，每次只读取一页数据
+    try:
+        page = paginate_movies(stmt,
+            sort=request.args.get('sort', 'id'),
+            after=request.args.get('after'),
+            before=request.args.get('before'),
+            per_page=request.args.get('per_page', type=int))
+    except ValueError:
+        abort(400)
+    body = render_template('index.html', 
+    movies = page.items, page=page, year_from=year_from, year_to=year_to, **list_context(owner, username))
+    if not cacheable:
+        return body
+    page_cache.set(cache_key, (body, etag, last_modified), generation)
+    return conditional_response(body, etag, last_modified)
+
+def find_owner(username):
+    """Return the Profile whose list is shown.
+
+    That is ``username``'s for the public /u/ pages, otherwise the logged in
+    user's own list, or the site owner's for anonymous visitors.
+    """
+    if username is not None:
+        return Profile.from_user(User.query.filter_by(username=username).first_or_404())
+    if current_user.is_authenticated:
+        return current_user._get_current_object()
+    owner = owner_cache.get()
+    if owner is None:
+        abort(404)
+    return owner
+
+def list_context(owner, username):
+    """Template variables shared by the list pages."""
+    # user 覆盖上下文处理函数的值，页面标题显示列表主人的名字；只有主人能看到编辑按钮
+    editable = current_user.is_authenticated and current_user.id == owner.id
+    return dict(user=owner, username=username, editable=editable)
+
+def write_movie(fn, *args):
+    """Run a single-statement write operation and commit it, return its result.
+
+    With the write queue enabled the operation is batched with other requests'
+    writes; otherwise it runs in the request session. Nothing is committed when
+    the operation reports that no row matched.
+
+    If the queue gives no answer within WRITE_QUEUE_TIMEOUT the request ends
+    with 503. The outcome is unknown then: the operation stays queued and may
+    still be applied after the response was sent.
+    """
+    if app.config['WRITE_QUEUE_ENABLED']:
+        try:
+            return write_queue.submit(fn, *args).result(app.config['WRITE_QUEUE_TIMEOUT'])
+        except FutureTimeoutError:
+            abort(503, retry_after=1)
+    result = fn(db.session, *args)
+    if not result:
+        db.session.rollback()
+        return result
+    Revision.bump()
+    db.session.commit()
+    page_cache.invalidate()
+    return result
+
+def conditional_response(body, etag, last_modified):
+    """Build a revalidatable response, 304 if the client already has this version."""
+    response = make_response(body)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.vary.add('Cookie') # 登录与否页面不同
+    response.cache_control.no_cache = True
+    if current_user.is_authenticated:
+        response.cache_control.private = True
+    return response.make_conditional(request)
+
+def stream_template(template_name, **context):
+    """Render a template chunk by chunk instead of building the whole page in memory."""
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(app.config['STREAM_BUFFER_SIZE'])
+    return stream
+
+@app.route('/all', defaults={'username': None})
+@app.route('/u/<username>/all')
+def show_all(username):
+    """Stream every movie, memory use does not grow with the list"""
+    # 响应头发出后无法再修改 session，先取出提示消息
+    get_flashed_messages()
+    owner = find_owner(username)
+    movies = stream_movies(owner.id, app.config['STREAM_BATCH_SIZE'])
+    return Response(stream_with_context(stream_template('all.html', movies=movies, **list_context(owner, username))))
+
+@app.route('/export.<any(csv, ndjson):fmt>', defaults={'username': None})
+@app.route('/u/<username>/export.<any(csv, ndjson):fmt>')
+def export(fmt, username):
+    """Stream the whole list as CSV or NDJSON, gzipped when the client accepts it"""
+    exporter, mimetype = EXPORTERS[fmt]
+    owner = find_owner(username)
+    chunks = exporter(stream_movies(owner.id, app.config['STREAM_BATCH_SIZE']))
+    headers = {'Content-Disposition': 'attachment; filename=watchlist.%s' % fmt, 'Vary': 'Accept-Encoding'}
+    if request.accept_encodings['gzip']:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
+
+@app.route('/search', defaults={'username': None})
+@app.route('/u/<username>/search')
+def search(username):
+    """Search titles through the full-text index"""
+    q = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    owner = find_owner(username)
+    try:
+        movies, has_next = search_movies(q, owner.id, page=page, per_page=request.args.get('per_page', type=int))
+    except ValueError:
+        abort(400)
+    return render_template('search.html', 
+    q=q, movies=movies, page=max(page, 1), has_next=has_next, **list_context(owner, username))
 
 @app.route('/movie/edit/<int:movie_id>', methods=['GET', 'POST'])
+@rate_limit(write_limiter)
 @login_required  # 登录保护
 def edit(movie_id):
-    movie = Movie.query.get_or_404(movie_id)
     if request.method == 'POST':
-        title = request.form['title']
-        year = request.form['year']
-
-        if not title or not year or len(year)>4 or len(title)>60:
+        try:
+            title, year = validate_movie(request.form['title'], request.form['year'], year_required=False)
+            # upgrade 把无法识别的年份改成了 NULL，只有这样的电影保存时可以不填年份
+            if year is None and Movie.query.filter_by(id=movie_id, user_id=current_user.id, year=None).first() is None:
+                raise ValueError('Invalid input.')
+        except ValueError:
             flash('Invalid input.')
             return redirect(url_for('edit', movie_id=movie_id))
 
-        movie.title = title
-        movie.year = year
-        db.session.commit()
+        # 一条 UPDATE 语句，根据影响的行数判断条目是否存在
+        try:
+            updated = write_movie(update_movie, current_user.id, movie_id, title, year)
+        except IntegrityError:
+            db.session.rollback()
+            flash('Item already exists.')
+            return redirect(url_for('edit', movie_id=movie_id))
+        if not updated:
+            abort(404)
         flash('Item updated.')
         return redirect(url_for('index'))
+    movie = Movie.query.filter_by(id=movie_id, user_id=current_user.id).first_or_404()
     return render_template('edit.html', 
     movie=movie)
 
 @app.route('/movie/delete/<int:movie_id>', methods=['POST'])
+@rate_limit(write_limiter)
 @login_required # 登录保护
 def delete(movie_id):
-    movie = Movie.query.get_or_404(movie_id)
-    db.session.delete(movie)
-    db.session.commit()
+    if not write_movie(delete_movie, current_user.id, movie_id):
+        abort(404)
     flash('Item deleted.')
     return redirect(url_for('index'))
 
+@app.route('/movie/batch', methods=['POST'])
+@rate_limit(write_limiter)
+@login_required
+def batch():
+    """Delete or set the year of the selected items in one transaction"""
+    movie_ids = sorted(set(request.form.getlist('ids', type=int)))
+    if len(movie_ids) > app.config['BULK_MAX_ITEMS']:
+        abort(413)
+    action = request.form.get('action')
+    if action not in ('delete', 'set_year'):
+        abort(400)
+
+    if action == 'delete':
+        count = write_movie(delete_movies, current_user.id, movie_ids) if movie_ids else 0
+        flash('%d items deleted.' % count)
+    else:
+        try:
+            year = validate_year(request.form.get('year'))
+        except ValueError:
+            flash('Invalid input.')
+            return redirect(url_for('index'))
+        count = write_movie(update_movies_year, current_user.id, movie_ids, year) if movie_ids else 0
+        flash('%d items updated.' % count)
+    return redirect(url_for('index'))
+
+def read_bulk_items():
+    """Parse a JSON array or newline-delimited JSON body, None for lines that are not JSON."""
+    if request.mimetype == 'application/json':
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            abort(400)
+        return items
+    items = []
+    for line in request.get_data(as_text=True).splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError:
+            items.append(None)
+    return items
+
+@app.route('/movie/bulk', methods=['POST'])
+@rate_limit(write_limiter)
+@login_required
+def bulk_create():
+    """Add many items in one transaction"""
+    items = read_bulk_items()
+    if len(items) > app.config['BULK_MAX_ITEMS']:
+        abort(413)
+
+    rows, results = [], []
+    for index, item in enumerate(items):
+        try:
+            rows.append(validate_movie_item(item))
+        except ValueError as e:
+            results.append({'index': index, 'status': 'invalid', 'error': str(e)})
+            continue
+        results.append({'index': index})
+
+    # executemany 插入全部条目，已存在的跳过，只提交一次
+    inserted = iter(write_movie(insert_movies, current_user.id, rows) if rows else [])
+    for result in results:
+        if 'status' not in result:
+            result['status'] = 'created' if next(inserted) else 'duplicate'
+    created = sum(1 for result in results if result['status'] == 'created')
+    return jsonify(created=created, duplicate=len(rows) - created,
+                   invalid=len(results) - len(rows), results=results)
+
 @app.route('/login', methods=['GET', 'POST'])
+@rate_limit(login_limiter, username_field='username')
 def login():
     if request.method == 'POST':
         username = request.form['username']
@@ -69,8 +308,23 @@ def login():
             flash('Invalid input.')
             return redirect(url_for('login'))
 
-        user = User.query.first()
-        if username == user.username and user.validate_password(password):
+        user = User.query.filter_by(username=username).first() # 走 username 唯一索引
+        # 哈希计算放到有上限的线程池中，大量登录请求不会占满处理页面的 worker
+        timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        try:
+            # 用户不存在时也校验一次哈希，响应时间不会暴露用户名是否存在
+            password_hash = user.password_hash if user is not None else dummy_password_hash()
+            valid = hash_pool.run(check_password_hash, password_hash, password, timeout=timeout) \
+                and user is not None
+            if valid and user.needs_rehash():
+                # 哈希设置改过，用这次登录的明文密码按新设置重新计算
+                user.password_hash = hash_pool.run(
+                    generate_password_hash, password, *password_hash_options(), timeout=timeout)
+                db.session.commit()
+        except (HashPoolBusy, FutureTimeoutError):
+            flash('Too many login attempts, please try again later.')
+            return render_template('login.html'), 503
+        if valid:
             login_user(user)
             flash('Login success.')
             return redirect(url_for('index'))
@@ -96,8 +350,13 @@ def setting():
             flash('Invalid input.')
             return redirect(url_for('setting'))
 
-        current_user.name = name
+        # current_user 是缓存的只读快照，直接更新数据库
+        User.query.filter_by(id=current_user.id).update({'name': name})
+        Revision.bump()
         db.session.commit()
+        user_cache.pop(current_user.id)
+        owner_cache.invalidate()
+        page_cache.invalidate() # 页面标题中显示用户名
         flash('Setting updated.')
         return redirect(url_for('index'))
     return render_template('setting.html')
\ No newline at end of file
@@ -0,0 +1,99 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class WriteQueue(object):
+    """Run write operations on a single thread and commit them in small batches.
+
+    Each operation is a function ``fn(connection, *args)`` issuing its own
+    statements; submit() returns a Future with its result. The writer thread
+    collects up to ``max_batch`` operations, waiting at most ``max_delay``
+    seconds after the first one, runs them in one transaction and commits
+    once, so a burst of requests shares a single fsync and never competes
+    for the SQLite write lock. An operation that raises fails only its own
+    Future; ``before_commit(connection)`` and ``after_commit()`` run once per
+    batch that changed something.
+    """
+
+    def __init__(self, get_engine, max_batch=64, max_delay=0.005, before_commit=None, after_commit=None):
+        self.get_engine = get_engine
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.before_commit = before_commit
+        self.after_commit = after_commit
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        future = Future()
+        self._ensure_started()
+        self._queue.put((future, fn, args))
+        return future
+
+    def stop(self):
+        """Finish the queued operations and stop the writer thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='write-queue', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._execute(batch)
+
+    def _execute(self, batch):
+        outcomes = []
+        try:
+            with self.get_engine().begin() as connection:
+                for future, fn, args in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        outcomes.append((future, fn(connection, *args), None))
+                    except Exception as e:
+                        # SQLite 只回滚出错的那条语句，同一批的其他操作不受影响
+                        outcomes.append((future, None, e))
+                if self.before_commit is not None and any(e is None for _, _, e in outcomes):
+                    self.before_commit(connection)
+        except Exception as e:
+            # 提交失败，整批操作都没有生效
+            for future, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if self.after_commit is not None and any(e is None for _, _, e in outcomes):
+            self.after_commit()
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)